@@ -1,20 +1,36 @@
 #!/usr/bin/env python
 
-from fpdf import FPDF
+from fpdf import FPDF, FPDF_VERSION
+from fpdf.php import UTF8ToUTF16BE
+from fpdf.ttfonts import TTFontFile
 from HTMLParser import HTMLParser
-from markdown import markdown
 
-import fpdf
+import array
+import cPickle
+import collections
+import getopt
+import glob
+import hashlib
+import json
+import math
 import re
+import signal
 import sys
+import tempfile
+import thread
+import threading
+import time
+import zlib
 import yaml
 import yaml.constructor
 import itertools
+import os
 import os.path
-import pygments
-import pygments.util
-import pygments.lexers
-import pygments.styles
+import Queue
+
+# markdown, pygments, multiprocessing and the modules of the render
+# server are imported on first use, they are not needed to start up,
+# or to re-use cached slides.
 
 try:
     # included in standard lib from Python 2.7
@@ -24,19 +40,106 @@ except ImportError:
     # it's available on PyPI
     from ordereddict import OrderedDict
 
+try:
+    # optional, needed to scale down images
+    from PIL import Image
+except ImportError:
+    Image = None
+
 def pairwise(iterable):
     "s -> (s0,s1), (s1,s2), (s2, s3), ..."
     a, b = itertools.tee(iterable)
     next(b, None)
     return itertools.izip_longest(a, b)
 
-class OrderedDictYAMLLoader(yaml.Loader):
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "peacock")
+
+def file_digest(fname):
+    with open(fname, "rb") as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+class DiskCache(object):
+    """
+    A directory of pickled objects, keyed by content hashes.
+
+    Each object is stored in its own file, and is read back with a
+    single read. The cache is only an optimization, any failure to
+    read or write an entry is treated as a miss.
+    """
+
+    # Bump when the format of any cached object changes.
+    VERSION = 2
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        # Files under this directory are gone after the build, nothing
+        # derived from them is stored, see serve_render()
+        self.transient_dir = None
+
+    def key(self, *parts):
+        h = hashlib.sha1("peacock-cache-%d" % self.VERSION)
+        for part in parts:
+            h.update(repr(part))
+            h.update("\0")
+        return h.hexdigest()
+
+    def __path(self, kind, key):
+        return os.path.join(self.dirname, kind, key)
+
+    def get(self, kind, key):
+        try:
+            with open(self.__path(kind, key), "rb") as fp:
+                data = fp.read()
+            return cPickle.loads(data)
+        except (IOError, EOFError, ValueError, TypeError,
+                AttributeError, ImportError, cPickle.UnpicklingError):
+            return None
+
+    def is_transient(self, fname):
+        """Return whether fname is gone after the build."""
+        return bool(self.transient_dir and
+                    os.path.abspath(fname).startswith(
+                        os.path.join(self.transient_dir, "")))
+
+    def digest(self, fname):
+        """Return the content hash of fname.
+
+        Hashes are remembered against the file's size and mtime, so
+        unchanged files are not read again.
+        """
+        if self.is_transient(fname):
+            return file_digest(fname)
+        fname = os.path.abspath(fname)
+        st = os.stat(fname)
+        key = self.key(fname, st.st_size, st.st_mtime)
+        digest = self.get("digest", key)
+        if digest is None:
+            digest = file_digest(fname)
+            self.put("digest", key, digest)
+        return digest
+
+    def put(self, kind, key, obj):
+        path = self.__path(kind, key)
+        tmp = "%s.%d.%d.tmp" % (path, os.getpid(), thread.get_ident())
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(tmp, "wb") as fp:
+                cPickle.dump(obj, fp, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass
+
+class OrderedDictConstructor(object):
     """
-    A YAML loader that loads mappings into ordered dictionaries.
+    A mixin for YAML loaders, that loads mappings into ordered
+    dictionaries.
     """
 
     def __init__(self, *args, **kwargs):
-        yaml.Loader.__init__(self, *args, **kwargs)
+        super(OrderedDictConstructor, self).__init__(*args, **kwargs)
 
         self.add_constructor(u'tag:yaml.org,2002:map', type(self).construct_yaml_map)
         self.add_constructor(u'tag:yaml.org,2002:omap', type(self).construct_yaml_map)
@@ -66,6 +169,78 @@ class OrderedDictYAMLLoader(yaml.Loader):
             mapping[key] = value
         return mapping
 
+# Presentations only need the standard YAML tags, the safe loaders
+# do not construct arbitrary Python objects.
+class OrderedDictYAMLLoader(OrderedDictConstructor, yaml.SafeLoader):
+    pass
+
+try:
+    # Parses with LibYAML, if PyYAML was built with it
+    class OrderedDictCYAMLLoader(OrderedDictConstructor, yaml.CSafeLoader):
+        pass
+except AttributeError:
+    OrderedDictCYAMLLoader = None
+
+def load_yaml_all(fname):
+    """Yield the documents of a YAML file, one at a time as parsed.
+
+    Mappings are loaded into ordered dictionaries. The LibYAML parser
+    is used when available. It differs from the Python parser in
+    corner cases, so a file it rejects is parsed again by the Python
+    parser, which yields the rest of the documents or reports its
+    error.
+    """
+    with open(fname) as fp:
+        count = 0
+        if OrderedDictCYAMLLoader:
+            try:
+                for doc in yaml.load_all(fp, Loader=OrderedDictCYAMLLoader):
+                    count += 1
+                    yield doc
+                return
+            except yaml.YAMLError:
+                fp.seek(0)
+        for i, doc in enumerate(yaml.load_all(fp, Loader=OrderedDictYAMLLoader)):
+            if i >= count:
+                yield doc
+
+def load_source(fname, cache=None):
+    """Yield the documents of an input file, one at a time.
+
+    With a cache, each parsed document is stored, keyed by the
+    content of the file and the position of the document, and is
+    read back instead of parsing the file again.
+    """
+    if cache is None or cache.is_transient(fname):
+        for doc in load_yaml_all(fname):
+            yield doc
+        return
+
+    digest = cache.digest(fname)
+    count = 0
+    while True:
+        entry = cache.get("source", cache.key(digest, yaml.__version__, count))
+        if entry is None:
+            break
+        if entry[0] == "end":
+            return
+        yield entry[1]
+        count += 1
+
+    # Parse the documents not in the cache
+    i = -1
+    for i, doc in enumerate(load_yaml_all(fname)):
+        if i >= count:
+            cache.put("source", cache.key(digest, yaml.__version__, i),
+                      ("doc", doc))
+            yield doc
+    cache.put("source", cache.key(digest, yaml.__version__, i + 1), ("end",))
+
+def is_section(doc):
+    """Return whether an input document is a section, not a slide set."""
+    return (isinstance(doc, dict) and len(doc) == 1 and
+            isinstance(doc.get("section", None), basestring))
+
 class FormatError(Exception):
     pass
 
@@ -75,12 +250,12 @@ class ThemeError(Exception):
 class Para(object):
     def __init__(self, pdf):
         self.pdf = pdf
-        self.pdf.set_text_color(*self.pdf.theme["l0-color"])
-        self.pdf.set_font(*self.pdf.theme["l0-font"])
+        self.lstyle = self.pdf.list_style(0)
+        self.pdf.set_text_color(*self.lstyle.color)
+        self.pdf.set_font(*self.lstyle.font)
 
     def style_changed(self, style):
-        self.pdf.set_font(self.pdf.theme["body-font"], style,
-                          self.pdf.theme["l0-size"])
+        self.pdf.set_font(self.lstyle.family, style, self.lstyle.size)
 
     def end(self):
         self.pdf.ln(0.01)
@@ -110,107 +285,326 @@ class CenterImage(BaseImage):
         
         self.pdf.set_y(self.pdf.y + self.height)
 
+        # Images are not split across pages, they run off the bottom
+        if self.pdf.y > self.pdf.page_break_trigger:
+            self.pdf.overflow = True
 
-class HTMLRenderer(HTMLParser):
-    def __init__(self, pdf):
-        HTMLParser.__init__(self)
-        self.pdf = pdf
-        self.curr_list = None
-        self.in_item = False
+# Markdown parser of text elements, created on first use, and the
+# events of parsed texts
+text_markdown = None
+text_events = {}
+TEXT_EVENTS_MAX = 1024
+
+UNESCAPE_RE = None
+PLACEHOLDER_RE = None
+WHITESPACE_RE = re.compile(r"\s+", re.UNICODE)
+
+# Inline elements, and the style they set
+TEXT_STYLES = { "em": "I", "strong": "B", "code": "M" }
+
+# An item of a plain bullet list: a marker, indented by four spaces for
+# each level, and words with punctuation that is not Markdown markup.
+PLAIN_ITEM_RE = re.compile(r"( *)[*+-] ((?:[^\W_]|[ ,.;:?!'\"()/%+=-])+)$",
+                           re.UNICODE)
+ORDERED_ITEM_RE = re.compile(r"\d+\.")
 
-    def handle_starttag(self, tag, attrs):
+def get_markdown():
+    global text_markdown, UNESCAPE_RE, PLACEHOLDER_RE
+
+    if text_markdown is None:
+        import markdown
+        import markdown.util
+
+        UNESCAPE_RE = re.compile(u"%s(\\d+)%s" % (markdown.util.STX,
+                                                  markdown.util.ETX))
+        PLACEHOLDER_RE = re.compile(markdown.util.HTML_PLACEHOLDER % r"(\d+)")
+        text_markdown = markdown.Markdown()
+    return text_markdown
+
+def plain_list_events(text):
+    """Return the events of text that is a plain bullet list, or None.
+
+    This is the common case, and is laid out without the Markdown
+    parser. Anything else, like inline markup, blank lines between
+    items or continued items, gets None, and is left to the parser.
+    """
+    lines = unicode(text).split("\n")
+    while lines and not lines[-1].strip():
+        lines.pop()
+    while lines and not lines[0]:
+        lines.pop(0)
+    if not lines:
+        return None
+
+    events = []
+    depth = 0
+    for line in lines:
+        m = PLAIN_ITEM_RE.match(line)
+        if not m:
+            return None
+        level, extra = divmod(len(m.group(1)), 4)
+        data = m.group(2)
+        if (extra or level > depth or not data[0].isalnum() or data[-1] == " "
+            or ORDERED_ITEM_RE.match(data)):
+            return None
+
+        if level == depth:
+            events.append(("list",))
+            depth += 1
+        else:
+            events.append(("end-item",))
+            while depth > level + 1:
+                events.append(("end-list",))
+                events.append(("end-item",))
+                depth -= 1
+        events.append(("item",))
+        events.append(("text", WHITESPACE_RE.sub(" ", data)))
+
+    while depth:
+        events.append(("end-item",))
+        events.append(("end-list",))
+        depth -= 1
+    return events
+
+def markdown_events(text):
+    """Parse Markdown text into a list of layout events.
+
+    Each event is a tuple, one of ("list",), ("end-list",), ("item",),
+    ("end-item",), ("style", style), ("end-style",) and ("text", text),
+    where style is "I", "B" or "M", for emphasis, strong emphasis and
+    code. The events are memoized per text.
+    """
+    events = text_events.get(text)
+    if events is not None:
+        return events
+
+    events = plain_list_events(text)
+    if events is None:
+        events = parse_markdown(text)
+
+    if len(text_events) >= TEXT_EVENTS_MAX:
+        text_events.clear()
+    text_events[text] = events
+    return events
+
+def parse_markdown(text):
+    md = get_markdown()
+    md.reset()
+    lines = unicode(text).split("\n")
+    for prep in md.preprocessors:
+        lines = prep.run(lines)
+    root = md.parser.parseDocument(lines).getroot()
+    root = md.treeprocessors["inline"].run(root) or root
+
+    def placeholder(m):
+        html = md.htmlStash.rawHtmlBlocks[int(m.group(1))]
+        if not html.startswith("&"):
+            raise FormatError("unsupported markup '%s' in text" % html)
+        return HTMLParser().unescape(html)
+
+    def add_text(data, in_item):
+        if not data or not in_item:
+            return
+        data = UNESCAPE_RE.sub(lambda m: unichr(int(m.group(1))), data)
+        data = PLACEHOLDER_RE.sub(placeholder, data)
+        data = WHITESPACE_RE.sub(" ", data)
+        if data:
+            events.append(("text", data))
+
+    def walk(elem, in_item):
+        tag = elem.tag
         if tag == "ul":
-            if self.curr_list != None:
-                self.curr_list.write("\n")
-            self.curr_list = List(self.pdf, "*", self.curr_list)
+            events.append(("list",))
         elif tag == "li":
-            self.curr_list.start_item()
-            self.in_item = True
-        elif tag == "em":
-            self.curr_list.start_italic()
-        elif tag == "strong":
-            self.curr_list.start_bold()
-        elif tag == "code":
-            # FIXME: need to implement code
-            pass
-        elif tag == "p":
-            pass
-        else:
+            events.append(("item",))
+            in_item = True
+        elif tag in TEXT_STYLES:
+            events.append(("style", TEXT_STYLES[tag]))
+        elif tag not in ("div", "p"):
             raise FormatError("unsupported markup '%s' in text" % tag)
 
-    def handle_endtag(self, tag):
+        if tag == "code":
+            add_text(HTMLParser().unescape(elem.text), in_item)
+        else:
+            add_text(elem.text, in_item)
+            for child in elem:
+                walk(child, in_item)
+                add_text(child.tail, in_item)
+
         if tag == "ul":
-            self.curr_list = self.curr_list.end_list()
+            events.append(("end-list",))
         elif tag == "li":
-            self.curr_list.end_item()
-            self.in_item = False
-        elif tag == "em":
-            self.curr_list.end_italic()
-        elif tag == "strong":
-            self.curr_list.end_bold()
-        elif tag == "code":
-            self.curr_list.end_mono()
-        elif tag == "p":
-            pass
-        else:
-            raise FormatError("unsupported markup '%s' in text" % tag)
+            events.append(("end-item",))
+        elif tag in TEXT_STYLES:
+            events.append(("end-style",))
 
-    def handle_data(self, data):
-        if not self.in_item:
-            return
-        
-        for i, ch in enumerate(data):
-            if not ch.isspace():
-                break
+    events = []
+    walk(root, False)
+    return events
 
-        leading = i
+class TextRenderer(object):
+    def __init__(self, pdf):
+        self.pdf = pdf
+        self.curr_list = None
 
-        for i, ch in enumerate(data[::-1]):
-            if not ch.isspace():
-                break
+    def render(self, events):
+        for event in events:
+            kind = event[0]
+            if kind == "text":
+                self.curr_list.write(event[1])
+            elif kind == "style":
+                self.curr_list.start_style(event[1])
+            elif kind == "end-style":
+                self.curr_list.end_style()
+            elif kind == "item":
+                self.curr_list.start_item()
+            elif kind == "end-item":
+                self.curr_list.end_item()
+            elif kind == "list":
+                if self.curr_list != None:
+                    self.curr_list.write("\n")
+                self.curr_list = List(self.pdf, "*", self.curr_list)
+            elif kind == "end-list":
+                self.curr_list = self.curr_list.end_list()
 
-        trailing = i
+class Text(object):
+    def __init__(self, pdf, text):
+        renderer = TextRenderer(pdf)
+        renderer.render(markdown_events(text["text"]))
 
-        idata = data[leading:len(data)-trailing]
-        idata = " ".join(idata.split())
+# Lexers and style tables, shared by all code blocks in the process
+lexers = {}
+style_tables = {}
 
-        data = data[:leading] + idata + data[len(data)-trailing:]
-        self.curr_list.write(data)
+def get_lexer(lang):
+    if lang not in lexers:
+        import pygments.lexers
+        import pygments.util
 
-class Text(object):
-    def __init__(self, pdf, text):
-        html = markdown(unicode(text["text"]))
-        print html
-        renderer = HTMLRenderer(pdf)
-        renderer.feed(html)
+        try:
+            lexers[lang] = pygments.lexers.get_lexer_by_name(lang)
+        except pygments.util.ClassNotFound:
+            raise FormatError("Unknown 'lang' '%s'" % lang)
+    return lexers[lang]
+
+def theme_code_style(theme):
+    """Return the code style of a theme, as used by get_style_table().
+
+    The theme selects a Pygments style with 'code-style', and can
+    override the colour of token types with 'code-colors', a map
+    from token type name to colour. The style is looked up, and its
+    table built, when the first code block is highlighted.
+    """
+    name = theme.get("code-style", "emacs")
+    colors = theme.get("code-colors", {})
+    if not isinstance(name, basestring) or not isinstance(colors, dict):
+        raise ThemeError("invalid 'code-style' or 'code-colors' in theme")
+
+    try:
+        colors = tuple(sorted((token, tuple(int(c) for c in rgb))
+                              for token, rgb in colors.iteritems()))
+    except (TypeError, ValueError):
+        raise ThemeError("invalid colour in 'code-colors', fmt: [ r, g, b ]")
+
+    for token, rgb in colors:
+        if len(rgb) != 3:
+            raise ThemeError("invalid colour for '%s' in 'code-colors'" % token)
+
+    return (name, colors)
+
+def get_style_table(style):
+    """Return a {token type: (font style, rgb)} table for a code style.
+
+    The table is built once for each style, and shared.
+    """
+    if style not in style_tables:
+        import pygments.styles
+        import pygments.token
+        import pygments.util
+
+        name, colors = style
+        try:
+            pstyle = pygments.styles.get_style_by_name(name)
+        except pygments.util.ClassNotFound:
+            raise ThemeError("Unknown code style '%s'" % name)
+
+        table = {}
+        for token, spec in pstyle:
+            fstyle = ""
+            if spec["bold"]:
+                fstyle += "B"
+            if spec["italic"]:
+                fstyle += "I"
+            if spec["color"]:
+                rgb = tuple(map(ord, spec["color"].decode("hex")))
+            else:
+                rgb = (0, 0, 0)
+            table[token] = (fstyle, rgb)
+
+        # A colour applies to the token type and all its sub-types,
+        # more specific types come later in the sorted overrides.
+        for token, rgb in colors:
+            ttype = pygments.token.string_to_tokentype(token)
+            token_style(table, ttype)
+            for subtype, (fstyle, old_rgb) in table.items():
+                if subtype in ttype:
+                    table[subtype] = (fstyle, rgb)
+        style_tables[style] = table
+    return style_tables[style]
+
+def token_style(table, token):
+    # Token types the style does not know look like their parent
+    if token not in table:
+        table[token] = token_style(table, token.parent)
+    return table[token]
+
+def highlight(code, lang, style, cache=None):
+    """Return the runs of highlighted code as (font style, rgb, text).
+
+    Adjacent tokens that look the same are merged into one run, and
+    white space is merged into the run before it. The runs are kept
+    in the cache, if given.
+    """
+    import pygments
+
+    if cache:
+        key = cache.key(code, lang, style, pygments.__version__)
+        runs = cache.get("code", key)
+        if runs is not None:
+            return runs
+
+    table = get_style_table(style)
+    runs = []
+    for token, text in pygments.lex(code, get_lexer(lang)):
+        fstyle, rgb = token_style(table, token)
+
+        if runs and (runs[-1][:2] == (fstyle, rgb) or
+                     text.isspace() and runs[-1][0] == fstyle):
+            runs[-1] = (runs[-1][0], runs[-1][1], runs[-1][2] + text)
+        else:
+            runs.append((fstyle, rgb, text))
+
+    if cache:
+        cache.put("code", key, runs)
+    return runs
 
 class Code(object):
-    def __init__(self, pdf, code, lexer):
+    def __init__(self, pdf, code, lang, cache=None):
         self.pdf = pdf
         fname, fstyle, fsize = self.pdf.theme["code-font"]
+        fsize *= self.pdf.text_scale
+        height = self.pdf.theme["code-height"] * self.pdf.text_scale
 
         self.pdf.set_font(fname, fstyle, fsize)
-        style = pygments.styles.get_style_by_name("emacs")
-        style = dict(style)
-        for token, text in pygments.lex(code["code"], lexer):
-            token_style = style[token]
-
-            if token_style["color"]:
-                r, g, b = map(ord, token_style["color"].decode("hex"))
-            else:
-                r, g, b = (0, 0, 0)
-            self.pdf.set_text_color(r, g, b)
-
-            if token_style["bold"] and token_style["italic"]:
-                self.pdf.set_font(fname, "BI", fsize)
-            elif token_style["bold"]:
-                self.pdf.set_font(fname, "B", fsize)
-            elif token_style["italic"]:
-                self.pdf.set_font(fname, "I", fsize)
-            else:
-                self.pdf.set_font(fname, "", fsize)
-
-            height = pdf.theme["code-height"]
+        if self.pdf.stats:
+            start = time.time()
+        runs = highlight(code["code"], lang, self.pdf.code_style, cache)
+        if self.pdf.stats:
+            self.pdf.stats.add_time("highlighting", start)
+
+        for fstyle, rgb, text in runs:
+            self.pdf.set_text_color(*rgb)
+            self.pdf.set_font(fname, fstyle, fsize)
             self.pdf.write(height, text)
 
 class FloatImage(BaseImage):
@@ -223,10 +617,37 @@ class FloatImage(BaseImage):
         img_margin = self.pdf.theme["lmargin-slide"]
         pad = 15
         self.pdf.set_left_margin(img_margin + self.width + pad)
-        print "Set Left Margin:", self.pdf.l_margin
         self.pdf.image(self.src, img_margin, self.pdf.t_margin,
                        self.width, self.height)
 
+class ListStyle(object):
+    """The theme settings of one list level.
+
+    Each setting comes from the theme's 'l<level>-' key, or from its
+    'ln-' key for levels without one. Sizes are multiplied by scale.
+    """
+    def __init__(self, theme, level, scale=1.0):
+        self.level = level
+        self.family, self.font_style, self.size = self.__param(theme, "font")
+        self.size *= scale
+        self.font = (self.family, self.font_style, self.size)
+        self.color = self.__param(theme, "color")
+        self.height = self.__param(theme, "height") * scale
+        self.space_before = self.__param(theme, "space-before") * scale
+        self.bullet = "%s  " % self.__param(theme, "bullet")
+        family, style, size = theme["bullet-font"]
+        self.bullet_font = (family, style, size * scale)
+        self.bullet_color = theme["bullet-color"]
+        # Measured in the bullet font, on first use
+        self.bullet_width = None
+
+    def __param(self, theme, name):
+        for key in ("l%d-%s" % (self.level, name), "ln-%s" % name):
+            if key in theme:
+                return theme[key]
+        raise ThemeError("'l%d-%s' or 'ln-%s' not present in theme"
+                         % (self.level, name, name))
+
 class List(object):
     def __init__(self, pdf, bullet, parent=None):
         self.pdf = pdf
@@ -242,59 +663,42 @@ class List(object):
         else:
             self.level = self.parent.level + 1
 
-        print self.level, self.pdf.l_margin
-
-    def __get_theme_param(self, param):
-        try:
-            return self.pdf.theme[param % self.level]
-        except KeyError:
-            return self.pdf.theme[param % "n"]
-
-    def __get_height(self):
-        return self.__get_theme_param("l%s-height")
-
-    def __get_font(self):
-        return self.__get_theme_param("l%s-font")
-
-    def __get_space_before(self):
-        return self.__get_theme_param("l%s-space-before")
+        self.lstyle = self.pdf.list_style(self.level)
 
-    def __get_color(self):
-        return self.__get_theme_param("l%s-color")
-
-    def __get_bullet(self):
+    def __put_bullet(self):
+        lstyle = self.lstyle
         if self.bullet == "1":
-            font_size = self.__get_font_size()
-            self.pdf.set_font(self.pdf.theme["body-font"], '', font_size)            
-            return "%d.  " % self.icount
+            self.pdf.set_font(*lstyle.font)
+            bullet = "%d.  " % self.icount
+            width = self.pdf.get_string_width(bullet)
         elif self.bullet == "*":
-            bullet = self.__get_theme_param("l%s-bullet")
-            self.pdf.set_font(*self.pdf.theme["bullet-font"])
-            return "%s  " % bullet
+            self.pdf.set_font(*lstyle.bullet_font)
+            bullet = lstyle.bullet
+            if lstyle.bullet_width is None:
+                lstyle.bullet_width = self.pdf.get_string_width(bullet)
+            width = lstyle.bullet_width
         else:
             raise ValueError("invalid bullet type")
 
+        self.pdf.set_text_color(*lstyle.bullet_color)
+        self.pdf.cell(width, lstyle.height, bullet, 0, 0, '')
+        return width
+
     def style_changed(self, style):
-        self.pdf.set_font(self.pdf.theme["body-font"], style,
-                          self.__get_font_size())
+        self.pdf.set_font(self.lstyle.family, style, self.lstyle.size)
 
     def start_item(self):
         if not self.first:
-            self.pdf.ln(self.__get_space_before())
+            self.pdf.ln(self.lstyle.space_before)
 
         self.first = False
 
-        bullet = self.__get_bullet()
-        # Get bullet width including margins
-        blt_width = self.pdf.get_string_width(bullet)
-
-        # Output bullet
-        self.pdf.set_text_color(*self.pdf.theme["bullet-color"])
-        self.pdf.cell(blt_width, self.__get_height(), bullet, 0, 0, '')
+        # Output bullet, and get its width including margins
+        blt_width = self.__put_bullet()
 
         # Setup for Text
-        self.pdf.set_font(*self.__get_font())
-        self.pdf.set_text_color(*self.__get_color())
+        self.pdf.set_font(*self.lstyle.font)
+        self.pdf.set_text_color(*self.lstyle.color)
 
         # Save left margin
         self.bullet_margin = self.pdf.l_margin
@@ -309,23 +713,443 @@ class List(object):
     def end_list(self):
         return self.parent
 
-    def start_italic(self):
-        self.style.append("I")
-
-    def start_bold(self):
-        self.style.append("B")
+    def start_style(self, style):
+        self.style.append(style)
 
-    def end_italic(self):
-        self.style.pop()
-
-    def end_bold(self):
+    def end_style(self):
         self.style.pop()
 
     def write(self, text):
-        style = "".join(set(self.style))
-        self.pdf.set_font("", style)
-        height = self.__get_height()
-        self.pdf.write(height, text)
+        # "M" selects the code font, in the current size
+        if "M" in self.style:
+            family = self.pdf.theme["code-font"][0]
+        else:
+            family = self.lstyle.family
+        style = ""
+        if "B" in self.style:
+            style += "B"
+        if "I" in self.style:
+            style += "I"
+        self.pdf.set_font(family, style)
+        self.pdf.write(self.lstyle.height, text)
+
+class TableStyle(object):
+    """The theme settings of tables.
+
+    Each setting comes from the theme's 'table-' key. The font, colour,
+    line height and space before default to those of the second list
+    level, and the header's font and colour to the body's. Sizes are
+    multiplied by scale.
+    """
+    def __init__(self, theme, scale=1.0):
+        lstyle = ListStyle(theme, 1, scale)
+        self.font = self.__font(theme, "table-font", lstyle.font, scale)
+        self.header_font = self.__font(theme, "table-header-font", self.font,
+                                       scale)
+        self.color = theme.get("table-color", lstyle.color)
+        self.header_color = theme.get("table-header-color", self.color)
+        self.header_fill = theme.get("table-header-fill")
+        self.stripe_fill = theme.get("table-stripe-fill")
+        self.rule_color = theme.get("table-rule-color", self.color)
+        self.height = theme.get("table-height", lstyle.height / scale) * scale
+        self.padding = theme.get("table-padding", 2) * scale
+        self.space_before = theme.get("table-space-before",
+                                      lstyle.space_before / scale) * scale
+
+    def __font(self, theme, key, default, scale):
+        if key not in theme:
+            return default
+        try:
+            family, style, size = theme[key]
+            return (family, style, size * scale)
+        except (TypeError, ValueError):
+            raise ThemeError("invalid '%s' in theme, fmt: [ name, style, size ]"
+                             % key)
+
+def table_cell(value):
+    """Return the text of a table cell, given as a string or a number."""
+    if value is None:
+        return ""
+    if isinstance(value, basestring):
+        return value
+    if isinstance(value, bool):
+        # YAML reads yes, no, on, off, true and false as booleans
+        raise FormatError("Expected text for table cell, found %s,"
+                          " quote it to show it as text" % value)
+    if isinstance(value, (int, long, float)):
+        return str(value)
+    raise FormatError("Expected text for table cell, found %s" % type(value))
+
+# Width of the rules under the header and the last row of a table, mm
+TABLE_RULE_WIDTH = 0.3
+
+class Table(object):
+    """
+    A table, whose header rows are repeated on every page it runs on.
+
+    Every cell is measured once, a word at a time, before anything is
+    drawn. Columns are as wide as their widest cell, or, when the table
+    would be wider than the space available, as wide as their longest
+    word, up to an even share of the space, plus a share of the rest
+    of it, in proportion to how much wider their widest cell is. Cells
+    wrap at the column width, and a row that does not fit on the page
+    is moved to the next one, so a table is laid out in time linear in
+    the number of cells.
+    """
+    def __init__(self, pdf, rows, header=1, align=()):
+        self.pdf = pdf
+        self.style = pdf.table_style()
+        self.ncols = max(len(row) for row in rows)
+        self.align = [ align[i] if i < len(align) else "L"
+                       for i in range(self.ncols) ]
+
+        # Both fonts are measured in while they are selected, the body
+        # first, so that the header font is still selected when the
+        # table is drawn.
+        self.fonts = [ None, None ]
+        self.rows = [ None, None ]
+        for i, font, part in ((1, self.style.font, rows[header:]),
+                              (0, self.style.header_font, rows[:header])):
+            self.pdf.set_font(*font)
+            self.fonts[i] = self.pdf.current_font
+            self.rows[i] = [ self.__measure_row(row) for row in part ]
+
+        # mm per 1/1000 of the font size, of the header and body fonts
+        self.sizes = [ font[2] / self.pdf.k / 1000.0
+                       for font in (self.style.header_font, self.style.font) ]
+        self.x = self.pdf.l_margin
+        self.widths = self.__column_widths()
+        self.width = sum(self.widths)
+        self.draw()
+
+    def __measure_row(self, row):
+        # Each cell is a list of paragraphs, a paragraph a list of
+        # (word, width) pairs, with widths in 1/1000 of the font size.
+        font = self.pdf.current_font
+        cells = []
+        for text in row + [ "" ] * (self.ncols - len(row)):
+            text = self.pdf.normalize_text(text)
+            cells.append([ [ (word, string_widths.width(font, word))
+                             for word in para.split() ]
+                           for para in text.split("\n") ])
+        return cells
+
+    def __column_widths(self):
+        pad = 2 * self.style.padding
+        widest = [ pad ] * self.ncols
+        longest = [ pad ] * self.ncols
+        for font, size, rows in zip(self.fonts, self.sizes, self.rows):
+            space = string_widths.width(font, " ")
+            for row in rows:
+                for i, cell in enumerate(row):
+                    for para in cell:
+                        if not para:
+                            continue
+                        words = [ w for word, w in para ]
+                        width = (sum(words) + space * (len(words) - 1)) * size
+                        widest[i] = max(widest[i], width + pad)
+                        longest[i] = max(longest[i], max(words) * size + pad)
+
+        avail = self.pdf.w - self.pdf.r_margin - self.pdf.l_margin
+        total_widest = sum(widest)
+        if total_widest <= avail:
+            return widest
+
+        # A word wider than an even share of the space is broken,
+        # rather than squeeze the other columns.
+        longest = [ min(l, max(avail / self.ncols, pad)) for l in longest ]
+        total_longest = sum(longest)
+        if total_longest >= avail:
+            return [ l * avail / total_longest for l in longest ]
+        share = (avail - total_longest) / (total_widest - total_longest)
+        return [ l + (w - l) * share for l, w in zip(longest, widest) ]
+
+    def __wrap(self, cell, width, font, size):
+        # Lines of a cell, broken at the words that do not fit. The
+        # widest cell of a column fits exactly, up to rounding.
+        wmax = (width - 2 * self.style.padding) / size + 1e-6
+        space = string_widths.width(font, " ")
+        lines = []
+        for para in cell:
+            line = []
+            lw = 0
+            for word, w in para:
+                if line and lw + space + w > wmax:
+                    lines.append(" ".join(line))
+                    line = []
+                if not line:
+                    if w > wmax:
+                        chunks = self.__break_word(word, wmax, font)
+                        lines.extend(chunks[:-1])
+                        word = chunks[-1]
+                        w = string_widths.width(font, word)
+                    lw = w
+                else:
+                    lw += space + w
+                line.append(word)
+            lines.append(" ".join(line))
+        return lines
+
+    def __break_word(self, word, wmax, font):
+        chunks = []
+        start = 0
+        lw = 0
+        for i, c in enumerate(word):
+            w = string_widths.width(font, c)
+            if lw + w > wmax and i > start:
+                chunks.append(word[start:i])
+                start = i
+                lw = 0
+            lw += w
+        chunks.append(word[start:])
+        return chunks
+
+    def __lay_out_row(self, row, part):
+        font = self.fonts[part]
+        size = self.sizes[part]
+        lines = [ self.__wrap(cell, width, font, size)
+                  for cell, width in zip(row, self.widths) ]
+        return lines, max(len(cell) for cell in lines) * self.style.height
+
+    def __draw_row(self, lines, height, font, color, fill):
+        pdf = self.pdf
+        y = pdf.y
+        if fill:
+            pdf.set_fill_color(*fill)
+            pdf.rect(self.x, y, self.width, height, "F")
+
+        # Cells are drawn inside the padding, fpdf adds c_margin
+        pdf.set_font(*font)
+        pdf.set_text_color(*color)
+        inset = self.style.padding - pdf.c_margin
+        h = self.style.height
+        x = self.x
+        for cell, width, align in zip(lines, self.widths, self.align):
+            for n, line in enumerate(cell):
+                pdf.set_xy(x + inset, y + n * h)
+                pdf.cell(width - 2 * inset, h, line, 0, 0, align)
+            x += width
+        pdf.set_xy(self.x, y + height)
+
+    def __draw_header(self, header):
+        style = self.style
+        if style.header_fill and header:
+            pdf = self.pdf
+            pdf.set_fill_color(*style.header_fill)
+            pdf.rect(self.x, pdf.y, self.width,
+                     sum(height for lines, height in header), "F")
+        for lines, height in header:
+            self.__draw_row(lines, height, style.header_font,
+                            style.header_color, None)
+        if header:
+            self.__rule()
+
+    def __rule(self):
+        pdf = self.pdf
+        pdf.set_draw_color(*self.style.rule_color)
+        pdf.set_line_width(TABLE_RULE_WIDTH * pdf.text_scale)
+        pdf.line(self.x, pdf.y, self.x + self.width, pdf.y)
+
+    def draw(self):
+        pdf = self.pdf
+        style = self.style
+        header = [ self.__lay_out_row(row, 0) for row in self.rows[0] ]
+        header_height = sum(height for lines, height in header)
+
+        pdf.ln(style.space_before)
+        self.x = pdf.l_margin
+
+        # Rows are moved to the next page as a whole, and are not
+        # broken by the cells in them.
+        auto_page_break = pdf.auto_page_break
+        pdf.auto_page_break = False
+        try:
+            rows_on_page = 0
+            for i, row in enumerate(self.rows[1]):
+                lines, height = self.__lay_out_row(row, 1)
+                if i == 0:
+                    if (pdf.y + header_height + height > pdf.page_break_trigger
+                        and pdf.y > pdf.t_margin + style.space_before):
+                        pdf.page_break(True)
+                    self.__draw_header(header)
+                elif (rows_on_page and
+                      pdf.y + height > pdf.page_break_trigger):
+                    self.__rule()
+                    pdf.page_break(True)
+                    self.__draw_header(header)
+                    rows_on_page = 0
+
+                fill = style.stripe_fill if i % 2 else None
+                self.__draw_row(lines, height, style.font, style.color, fill)
+                rows_on_page += 1
+
+                # Rows taller than a page run off its bottom
+                if pdf.y > pdf.page_break_trigger:
+                    pdf.overflow = True
+
+            if not self.rows[1]:
+                self.__draw_header(header)
+            else:
+                self.__rule()
+        finally:
+            pdf.auto_page_break = auto_page_break
+
+        if pdf.y > pdf.page_break_trigger:
+            pdf.overflow = True
+        pdf.x = pdf.l_margin
+
+# zlib level of compressed streams, fpdf's, see --compress
+COMPRESS_LEVEL = 6
+
+# Font selection operator, as emitted by fpdf
+FONT_SELECT_RE = re.compile(r"BT /F(\d+) ")
+
+# Maps the character codes of embedded TrueType fonts to Unicode, the
+# codes are the code points, as fpdf uses them.
+TO_UNICODE_CMAP = ("/CIDInit /ProcSet findresource begin\n"
+                   "12 dict begin\n"
+                   "begincmap\n"
+                   "/CIDSystemInfo\n"
+                   "<</Registry (Adobe)\n"
+                   "/Ordering (UCS)\n"
+                   "/Supplement 0\n"
+                   ">> def\n"
+                   "/CMapName /Adobe-Identity-UCS def\n"
+                   "/CMapType 2 def\n"
+                   "1 begincodespacerange\n"
+                   "<0000> <FFFF>\n"
+                   "endcodespacerange\n"
+                   "1 beginbfrange\n"
+                   "<0000> <FFFF> <0000>\n"
+                   "endbfrange\n"
+                   "endcmap\n"
+                   "CMapName currentdict /CMap defineresource pop\n"
+                   "end\n"
+                   "end")
+
+class StringWidths(object):
+    """Widths of strings in a font, in 1/1000 of the font size.
+
+    Measured widths are memoized, and about the size most recently
+    used ones are kept: a string that is not used again before size/2
+    other strings are measured is dropped. Fonts are told apart by
+    name and file, clear() forgets the widths when a file changes.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self.recent = {}
+        self.older = {}
+
+    def width(self, font, text):
+        key = (font["name"], font.get("ttffile"), text)
+        w = self.recent.get(key)
+        if w is None:
+            w = self.older.get(key)
+            if w is None:
+                w = self.measure(font, text)
+            if len(self.recent) >= self.size // 2:
+                self.older = self.recent
+                self.recent = {}
+            self.recent[key] = w
+        return w
+
+    def measure(self, font, text):
+        cw = font["cw"]
+        if font["type"] != "TTF":
+            return sum(cw.get(c, 0) for c in text)
+
+        n = len(cw)
+        missing = font["desc"]["MissingWidth"] or 500
+        w = 0
+        for c in text:
+            c = ord(c)
+            w += cw[c] if c < n else missing
+        return w
+
+# Word widths, shared by all documents in the process
+string_widths = StringWidths(16384)
+
+WORD_RE = re.compile(r"[^ \n]+")
+
+class StreamBuffer(object):
+    """Stands in for FPDF.buffer, writing the document to a file.
+
+    fpdf only ever appends to the buffer and takes its length, to
+    find the offsets of objects.
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.length = 0
+
+    def __iadd__(self, data):
+        self.fp.write(data)
+        self.length += len(data)
+        return self
+
+    def __len__(self):
+        return self.length
+
+class DisplayList(object):
+    """
+    The drawing operations of a slide, as laid out by PDF.begin_record().
+
+    Each operation is an opcode in ops, its numbers in nums, and its
+    other arguments, like text and font names, in args. Positions are
+    absolute, and a page break is an operation that carries the layout
+    state at the break. A display list can be pickled, to cache it or
+    to pass it between processes, and is turned into PDF operators by
+    PDF.emit().
+    """
+
+    # Opcodes: numbers, other arguments
+    FONT = 0        # size, underline; family, style
+    TEXT_COLOR = 1  # ; operator
+    DRAW_COLOR = 2  # r, g, b
+    FILL_COLOR = 3  # r, g, b
+    LINE_WIDTH = 4  # width
+    TEXT = 5        # x, y of the baseline; text
+    CELL = 6        # w, h, ln, fill; x, y, text, border, align, link
+    IMAGE = 7       # w, h; x, y, name
+    LINE = 8        # x1, y1, x2, y2
+    RECT = 9        # x, y, w, h; style
+    PAGE = 10       # ; state
+
+    def __init__(self, state):
+        self.ops = array.array("B")
+        self.nums = array.array("d")
+        self.args = []
+        self.start_state = state
+        self.end_state = None
+        # Text scale the slide was laid out at, see --fit
+        self.scale = 1.0
+        # Pages tables are continued on, see PDF.page_break()
+        self.planned_pages = 0
+        # Whether an image or a table row ran off the bottom of a page
+        self.overflow = False
+
+    def add(self, op, nums=(), args=()):
+        self.ops.append(op)
+        self.nums.extend(nums)
+        self.args.extend(args)
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __getstate__(self):
+        # Arrays pickle as lists, strings are far faster
+        state = self.__dict__.copy()
+        state["ops"] = self.ops.tostring()
+        state["nums"] = self.nums.tostring()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.ops = array.array("B", state["ops"])
+        self.nums = array.array("d")
+        self.nums.fromstring(state["nums"])
 
 class PDF(FPDF):
     def __init__(self, theme, theme_dir):
@@ -336,13 +1160,1104 @@ class PDF(FPDF):
                          self.theme["tmargin-slide"])
         self.img = None
         self.slide_title = None
+        self.code_style = theme_code_style(self.theme)
+
+        # Styles of list levels, all levels the theme sets are
+        # resolved up front, deeper ones and other scales when first
+        # used.
+        self.text_scale = 1.0
+        self.list_styles = {}
+        self.table_styles = {}
+        level = 0
+        while "l%d-font" % level in self.theme:
+            self.list_style(level)
+            level += 1
+
+        # Layout without output, see begin_dry_run()
+        self.dry_run = None
+        self.overflow = False
+        self.background = None
+        self.background_n = None
+
+        # Layout into a display list, see begin_record(), and the page
+        # content of one being emitted
+        self.dlist = None
+        self.emitted = None
+        self.font_metrics = []
+
+        # Indices of the fonts pages refer to, see _putfonts()
+        self.used_fonts = set()
+
+        # Image loading, see load_image()
+        self.cache = None
+        self.image_dpi = None
+        self.image_keys = {}
+        self.prefetcher = None
+
+        # Detailed timings and counters, see Stats
+        self.stats = None
+
+        # Streaming output, see begin_stream()
+        self.stream = None
+        self.nb_aliases = []
+        self.nb_ranges = []
+        self.nb_contents = []
+        self.page_objs = []
+
+        # Compression of streams, see set_compress_level()
+        self.compress_level = COMPRESS_LEVEL
+        self.compress_jobs = 1
+        self.compress_pool = None
+        self.pending_objs = collections.deque()
+
+        try:
+            self.background_code = compile(self.theme.get("slide-background", ""),
+                                           "slide-background", "exec")
+        except SyntaxError as e:
+            raise ThemeError("error in 'slide-background': %s" % e)
+
+    def get_string_width(self, s):
+        s = self.normalize_text(s)
+        return string_widths.width(self.current_font, s) * self.font_size / 1000.0
+
+    def write(self, h, txt='', link=''):
+        """Output text in flowing mode, like FPDF.write().
+
+        Breaks lines in the same places, but measures the text a word
+        at a time instead of a character at a time.
+        """
+        if not self.page:
+            self.error("No page open, you need to call add_page() first")
+
+        s = self.normalize_text(txt).replace("\r", "")
+        font = self.current_font
+        measure = string_widths.width
+        words = dict((m.start(), (m.end(), measure(font, m.group())))
+                     for m in WORD_RE.finditer(s))
+
+        w = self.w - self.r_margin - self.x
+        wmax = (w - 2 * self.c_margin) * 1000.0 / self.font_size
+        nb = len(s)
+        sep = -1
+        i = 0
+        j = 0
+        l = 0
+        nl = 1
+        while i < nb:
+            c = s[i]
+            if c == "\n":
+                # Explicit line break
+                self.cell(w, h, s[j:i], 0, 2, '', 0, link)
+                i += 1
+                sep = -1
+                j = i
+                l = 0
+                if nl == 1:
+                    self.x = self.l_margin
+                    w = self.w - self.r_margin - self.x
+                    wmax = (w - 2 * self.c_margin) * 1000.0 / self.font_size
+                nl += 1
+                continue
+
+            # A whole word that fits is taken in one step, otherwise
+            # the line is broken at the character that does not fit.
+            word = words.get(i)
+            if word and l + word[1] <= wmax:
+                i, cw = word
+                l += cw
+                continue
+
+            if c == " ":
+                sep = i
+            l += measure(font, c)
+            if l > wmax:
+                # Automatic line break
+                if sep == -1:
+                    if self.x > self.l_margin:
+                        # Move to next line
+                        self.x = self.l_margin
+                        self.y += h
+                        w = self.w - self.r_margin - self.x
+                        wmax = (w - 2 * self.c_margin) * 1000.0 / self.font_size
+                        i += 1
+                        nl += 1
+                        continue
+                    if i == j:
+                        i += 1
+                    self.cell(w, h, s[j:i], 0, 2, '', 0, link)
+                else:
+                    self.cell(w, h, s[j:sep], 0, 2, '', 0, link)
+                    i = sep + 1
+                sep = -1
+                j = i
+                l = 0
+                if nl == 1:
+                    self.x = self.l_margin
+                    w = self.w - self.r_margin - self.x
+                    wmax = (w - 2 * self.c_margin) * 1000.0 / self.font_size
+                nl += 1
+            else:
+                i += 1
+
+        # Last chunk
+        if i != j:
+            self.cell(l / 1000.0 * self.font_size, h, s[j:], 0, 0, '', 0, link)
+
+    def list_style(self, level):
+        key = (level, self.text_scale)
+        if key not in self.list_styles:
+            self.list_styles[key] = ListStyle(self.theme, level,
+                                              self.text_scale)
+        return self.list_styles[key]
+
+    def table_style(self):
+        if self.text_scale not in self.table_styles:
+            self.table_styles[self.text_scale] = TableStyle(self.theme,
+                                                            self.text_scale)
+        return self.table_styles[self.text_scale]
+
+    def begin_dry_run(self):
+        """Lay out what follows without output or page breaks.
+
+        The layout moves the position as usual, and end_dry_run()
+        tells whether it ran past the bottom of the page.
+        """
+        subsets = dict((key, len(font["subset"]))
+                       for key, font in self.fonts.iteritems()
+                       if "subset" in font)
+        self.dry_run = (self.get_state(), self.lasth, subsets, self.overflow)
+        self.overflow = False
+
+    def end_dry_run(self):
+        """Go back to where begin_dry_run() was called.
+
+        Returns True if the layout would have needed a page break.
+        """
+        state, self.lasth, subsets, overflow = self.dry_run
+        for key, length in subsets.iteritems():
+            del self.fonts[key]["subset"][length:]
+        self.dry_run = None
+        self.set_state(state)
+        overflow, self.overflow = self.overflow, overflow
+        return overflow
+
+    def accept_page_break(self):
+        if self.dry_run:
+            self.overflow = True
+            return False
+        return FPDF.accept_page_break(self)
+
+    def cell(self, w, h=0, txt='', border=0, ln=0, align='', fill=0, link=''):
+        if not self.dry_run and self.dlist is None:
+            FPDF.cell(self, w, h, txt, border, ln, align, fill, link)
+            return
+
+        # Only move the position, as FPDF.cell() does, and record the
+        # cell and page breaks.
+        if self.y + h > self.page_break_trigger and self.accept_page_break():
+            self.page_break()
+        if w == 0:
+            w = self.w - self.r_margin - self.x
+        if not self.dry_run:
+            self.__record_cell(w, h, txt, border, ln, align, fill, link)
+        self.lasth = h
+        if ln > 0:
+            self.y += h
+            if ln == 1:
+                self.x = self.l_margin
+        else:
+            self.x += w
+
+    def page_break(self, planned=False):
+        """Continue on the next page, as a cell that does not fit does.
+
+        A dry run notes the overflow instead. A planned break, of a
+        table between its rows, is not an overflow: a dry run goes on
+        at the top of the page, and a display list counts it.
+        """
+        if self.dry_run:
+            if planned:
+                self.y = self.t_margin
+            else:
+                self.overflow = True
+        elif self.dlist is not None:
+            self.dlist.add(DisplayList.PAGE, (), (self.get_state(),))
+            if planned:
+                self.dlist.planned_pages += 1
+            self.y = self.t_margin
+        else:
+            x = self.x
+            self.add_page(self.cur_orientation)
+            self.x = x
+
+    def __record_cell(self, w, h, txt, border, ln, align, fill, link):
+        # Plain text, the common case, is recorded as a run at its
+        # final position, which is all FPDF.cell() needs to draw it.
+        if border or fill or link or self.ws or self.underline:
+            self.dlist.add(DisplayList.CELL, (w, h, ln, fill),
+                           (self.x, self.y, txt, border, align, link))
+            return
+        if txt == "":
+            return
+        txt = self.normalize_text(txt)
+        if align == "R":
+            dx = w - self.c_margin - self.get_string_width(txt)
+        elif align == "C":
+            dx = (w - self.get_string_width(txt)) / 2.0
+        else:
+            dx = self.c_margin
+        self.dlist.add(DisplayList.TEXT,
+                       (self.x + dx, self.y + .5 * h + .3 * self.font_size),
+                       (txt,))
 
     def theme_file(self, filename):
         return os.path.join(self.theme_dir, filename)
-        
+
+    def set_font(self, family, style='', size=0):
+        if self.stats:
+            self.stats.count("fonts set")
+        if self.dlist is None or self.dry_run:
+            FPDF.set_font(self, family, style, size)
+            return
+
+        # Only changes are recorded, as resolved by FPDF.set_font().
+        before = (self.font_family, self.font_style, self.font_size_pt,
+                  self.underline)
+        FPDF.set_font(self, family, style, size)
+        after = (self.font_family, self.font_style, self.font_size_pt,
+                 self.underline)
+        if after != before:
+            self.dlist.add(DisplayList.FONT, (after[2], after[3]),
+                           (after[0], after[1]))
+
+    def set_text_color(self, r, g=-1, b=-1):
+        text_color = self.text_color
+        FPDF.set_text_color(self, r, g, b)
+        if (self.dlist is not None and not self.dry_run
+            and self.text_color != text_color):
+            self.dlist.add(DisplayList.TEXT_COLOR, (), (self.text_color,))
+
+    def set_draw_color(self, r, g=-1, b=-1):
+        if self.dlist is not None and not self.dry_run:
+            self.dlist.add(DisplayList.DRAW_COLOR, (r, g, b))
+        FPDF.set_draw_color(self, r, g, b)
+
+    def set_fill_color(self, r, g=-1, b=-1):
+        if self.dlist is not None and not self.dry_run:
+            self.dlist.add(DisplayList.FILL_COLOR, (r, g, b))
+        FPDF.set_fill_color(self, r, g, b)
+
+    def set_line_width(self, width):
+        if self.dlist is not None and not self.dry_run:
+            self.dlist.add(DisplayList.LINE_WIDTH, (width,))
+        FPDF.set_line_width(self, width)
+
+    def line(self, x1, y1, x2, y2):
+        if self.dlist is not None:
+            if not self.dry_run:
+                self.dlist.add(DisplayList.LINE, (x1, y1, x2, y2))
+            return
+        FPDF.line(self, x1, y1, x2, y2)
+
+    def rect(self, x, y, w, h, style=''):
+        if self.dlist is not None:
+            if not self.dry_run:
+                self.dlist.add(DisplayList.RECT, (x, y, w, h), (style,))
+            return
+        FPDF.rect(self, x, y, w, h, style)
+
+    def _endpage(self):
+        self.used_fonts.update(FONT_SELECT_RE.findall(self.pages[self.page]))
+        FPDF._endpage(self)
+        if self.stream is not None:
+            self.__flush_page()
+
+    def _out(self, s):
+        if self.emitted is not None and self.state == 2:
+            if isinstance(s, unicode):
+                s = s.encode("latin1")
+            self.emitted.append(s)
+            return
+
+        if (self.dry_run or self.dlist is not None) and self.state == 2:
+            return
+
+        if self.stream is None or self.state != 2:
+            FPDF._out(self, s)
+            return
+
+        start = len(self.pages[self.page])
+        FPDF._out(self, s)
+        self.__check_nb(start)
+
+    def __check_nb(self, start):
+        # Remember where the page count alias is used on the page,
+        # the content around it can be written out before the page
+        # count is known.
+        page = self.pages[self.page]
+        for alias in self.nb_aliases:
+            if page.find(alias, start) != -1:
+                self.nb_ranges.append((start, len(page)))
+                return
+
+    def begin_stream(self, fp):
+        """Write the document to fp while it is being built.
+
+        Each page is written out as soon as it is finished, along
+        with the images it uses, so that memory use does not grow
+        with the size of the document. Only the fonts, and the bits
+        of content that show the page count, are kept until close().
+        Links are not supported.
+        """
+        self.stream = fp
+        self.buffer = StreamBuffer(fp)
+        if hasattr(self, "str_alias_nb_pages"):
+            alias = self.str_alias_nb_pages
+            self.nb_aliases = [ UTF8ToUTF16BE(alias, False), alias ]
+        FPDF._putheader(self)
+
+    def set_compress_level(self, level):
+        """Compress streams at zlib level 1 to 9, or not at all at 0.
+
+        Images are written as they were parsed, or cached, whatever
+        the level, and fonts are always compressed.
+        """
+        self.compress_level = level
+        self.set_compression(level > 0)
+
+    def __compress_pool(self):
+        # zlib lets go of the interpreter lock while compressing, so
+        # threads compress in parallel.
+        if self.compress_pool is None and self.compress_jobs > 1:
+            from multiprocessing.pool import ThreadPool
+            self.compress_pool = ThreadPool(self.compress_jobs)
+        return self.compress_pool
+
+    def compress_streams(self, streams, level=None):
+        """Return the list of streams compressed, at level if given.
+
+        With compress_jobs > 1 they are compressed on that many
+        threads.
+        """
+        level = level or self.compress_level
+        streams = list(streams)
+        pool = self.__compress_pool() if len(streams) > 1 else None
+        if pool:
+            return pool.map(lambda data: zlib.compress(data, level), streams)
+        return [ zlib.compress(data, level) for data in streams ]
+
+    def close(self):
+        try:
+            FPDF.close(self)
+        finally:
+            if self.compress_pool:
+                self.compress_pool.close()
+                self.compress_pool.join()
+                self.compress_pool = None
+
+    def __reserve_obj(self):
+        self.n += 1
+        return self.n
+
+    def __put_obj(self, n, content):
+        # With compression threads, the page goes on being laid out
+        # while its content is compressed, and is written out later.
+        pool = self.__compress_pool() if self.compress else None
+        if pool:
+            content = pool.apply_async(zlib.compress,
+                                       (content, self.compress_level))
+        elif self.compress:
+            content = zlib.compress(content, self.compress_level)
+        self.pending_objs.append((n, content))
+        self.__put_pending(2 * self.compress_jobs)
+
+    def __put_pending(self, keep=0):
+        # Write out the objects put, in order, as they are compressed,
+        # and wait for them while more than keep are left.
+        while self.pending_objs:
+            n, content = self.pending_objs[0]
+            if not isinstance(content, basestring):
+                if len(self.pending_objs) <= keep and not content.ready():
+                    return
+                content = content.get()
+            self.pending_objs.popleft()
+
+            filter = "/Filter /FlateDecode " if self.compress else ""
+            self.offsets[n] = len(self.buffer)
+            self._out("%d 0 obj" % n)
+            self._out("<<%s/Length %d>>" % (filter, len(content)))
+            self._putstream(content)
+            self._out("endobj")
+
+    def __flush_page(self):
+        # The page is split into content streams, those that show
+        # the page count are written by _putpages().
+        page_n = self.__reserve_obj()
+        page = self.pages[self.page]
+        contents = []
+        pos = 0
+        for start, end in self.nb_ranges + [ (len(page), len(page)) ]:
+            if start > pos:
+                n = self.__reserve_obj()
+                self.__put_obj(n, page[pos:start])
+                contents.append(n)
+            if end > start:
+                n = self.__reserve_obj()
+                self.nb_contents.append((n, page[start:end]))
+                contents.append(n)
+            pos = end
+
+        self.offsets[page_n] = len(self.buffer)
+        self._out("%d 0 obj" % page_n)
+        self._out("<</Type /Page")
+        self._out("/Parent 1 0 R")
+        if self.page in self.orientation_changes:
+            self._out("/MediaBox [0 0 %.2f %.2f]" % (self.w_pt, self.h_pt))
+        self._out("/Resources 2 0 R")
+        if self.pdf_version > "1.3":
+            self._out("/Group <</Type /Group /S /Transparency /CS /DeviceRGB>>")
+        self._out("/Contents [%s]>>" % " ".join("%d 0 R" % n for n in contents))
+        self._out("endobj")
+        self.page_objs.append(page_n)
+
+        self.pages[self.page] = ""
+        self.nb_ranges = []
+        self.__put_new_images()
+
+    def _putheader(self):
+        # Already written by begin_stream()
+        if self.stream is None:
+            FPDF._putheader(self)
+
+    def _putpages(self):
+        if self.stream is None:
+            self.__put_pages()
+            return
+
+        nb = str(self.page)
+        aliases = [ UTF8ToUTF16BE(nb, False), nb ]
+        for n, content in self.nb_contents:
+            for alias, value in zip(self.nb_aliases, aliases):
+                content = content.replace(alias, value)
+            self.__put_obj(n, content)
+        self.nb_contents = []
+        self.__put_pending()
+
+        if self.def_orientation == "P":
+            w_pt, h_pt = self.fw_pt, self.fh_pt
+        else:
+            w_pt, h_pt = self.fh_pt, self.fw_pt
+
+        self.offsets[1] = len(self.buffer)
+        self._out("1 0 obj")
+        self._out("<</Type /Pages")
+        self._out("/Kids [%s]" % " ".join("%d 0 R" % n for n in self.page_objs))
+        self._out("/Count %d" % len(self.page_objs))
+        self._out("/MediaBox [0 0 %.2f %.2f]" % (w_pt, h_pt))
+        self._out(">>")
+        self._out("endobj")
+
+    def __put_pages(self):
+        # The same objects as FPDF._putpages() writes, with the page
+        # contents compressed all at once, see compress_streams().
+        nb = self.page
+        if hasattr(self, "str_alias_nb_pages"):
+            alias = self.str_alias_nb_pages
+            for alias, value in ((UTF8ToUTF16BE(alias, False),
+                                  UTF8ToUTF16BE(str(nb), False)),
+                                 (alias, str(nb))):
+                for n in range(1, nb + 1):
+                    self.pages[n] = self.pages[n].replace(alias, value)
+
+        if self.def_orientation == "P":
+            w_pt, h_pt = self.fw_pt, self.fh_pt
+        else:
+            w_pt, h_pt = self.fh_pt, self.fw_pt
+
+        contents = [ self.pages[n] for n in range(1, nb + 1) ]
+        if self.compress:
+            filter = "/Filter /FlateDecode "
+            if self.stats:
+                start = time.time()
+            contents = self.compress_streams(contents)
+            if self.stats:
+                self.stats.add_time("page compression", start)
+        else:
+            filter = ""
+
+        for n, content in zip(range(1, nb + 1), contents):
+            self._newobj()
+            self._out("<</Type /Page")
+            self._out("/Parent 1 0 R")
+            if n in self.orientation_changes:
+                self._out("/MediaBox [0 0 %.2f %.2f]" % (h_pt, w_pt))
+            self._out("/Resources 2 0 R")
+            if self.page_links and n in self.page_links:
+                self._out(self.__annots(n, h_pt, w_pt))
+            if self.pdf_version > "1.3":
+                self._out("/Group <</Type /Group /S /Transparency /CS /DeviceRGB>>")
+            self._out("/Contents %d 0 R>>" % (self.n + 1))
+            self._out("endobj")
+
+            self._newobj()
+            self._out("<<%s/Length %d>>" % (filter, len(content)))
+            self._putstream(content)
+            self._out("endobj")
+            self.pages[n] = ""
+
+        self.offsets[1] = len(self.buffer)
+        self._out("1 0 obj")
+        self._out("<</Type /Pages")
+        self._out("/Kids [%s]" % "".join("%d 0 R " % (3 + 2 * i)
+                                          for i in range(nb)))
+        self._out("/Count %d" % nb)
+        self._out("/MediaBox [0 0 %.2f %.2f]" % (w_pt, h_pt))
+        self._out(">>")
+        self._out("endobj")
+
+    def __annots(self, n, h_pt, w_pt):
+        annots = "/Annots ["
+        for pl in self.page_links[n]:
+            rect = "%.2f %.2f %.2f %.2f" % (pl[0], pl[1], pl[0] + pl[2],
+                                            pl[1] - pl[3])
+            annots += ("<</Type /Annot /Subtype /Link /Rect [%s] "
+                       "/Border [0 0 0] " % rect)
+            if isinstance(pl[4], basestring):
+                annots += "/A <</S /URI /URI %s>>>>" % self._textstring(pl[4])
+            else:
+                l = self.links[pl[4]]
+                h = w_pt if l[0] in self.orientation_changes else h_pt
+                annots += ("/Dest [%d 0 R /XYZ 0 %.2f null]>>"
+                           % (1 + 2 * l[0], h - l[1] * self.k))
+        return annots + "]"
+
+    def _putfonts(self):
+        # Fonts that no page refers to are left out. Only core and
+        # TrueType fonts are registered, by FPDF.set_font() and
+        # add_font_metrics().
+        used = set(int(index) for index in self.used_fonts)
+        for key, font in sorted(self.fonts.items(), key=lambda kf: kf[1]["i"]):
+            if font["i"] not in used:
+                del self.fonts[key]
+                continue
+
+            font["n"] = self.n + 1
+            if font["type"] == "TTF":
+                self.__put_ttf_font(font)
+                continue
+
+            self._newobj()
+            self._out("<</Type /Font")
+            self._out("/BaseFont /" + font["name"])
+            self._out("/Subtype /Type1")
+            if font["name"] not in ("Symbol", "ZapfDingbats"):
+                self._out("/Encoding /WinAnsiEncoding")
+            self._out(">>")
+            self._out("endobj")
+
+    def __put_ttf_font(self, font):
+        # The same objects as FPDF._putfonts() writes, from a subset
+        # that may come from the cache.
+        fontstream, size, widths, cidtogidmap = self.font_subset(font)
+        fontname = "MPDFAA+" + font["name"]
+        if self.stats:
+            self.stats.count("fonts embedded")
+
+        # Type0 font
+        self._newobj()
+        self._out("<</Type /Font")
+        self._out("/Subtype /Type0")
+        self._out("/BaseFont /" + fontname)
+        self._out("/Encoding /Identity-H")
+        self._out("/DescendantFonts [%d 0 R]" % (self.n + 1))
+        self._out("/ToUnicode %d 0 R" % (self.n + 2))
+        self._out(">>")
+        self._out("endobj")
+
+        # CIDFontType2
+        self._newobj()
+        self._out("<</Type /Font")
+        self._out("/Subtype /CIDFontType2")
+        self._out("/BaseFont /" + fontname)
+        self._out("/CIDSystemInfo %d 0 R" % (self.n + 2))
+        self._out("/FontDescriptor %d 0 R" % (self.n + 3))
+        if font["desc"].get("MissingWidth"):
+            self._out("/DW %d" % font["desc"]["MissingWidth"])
+        self._out(widths)
+        self._out("/CIDToGIDMap %d 0 R" % (self.n + 4))
+        self._out(">>")
+        self._out("endobj")
+
+        # ToUnicode
+        self._newobj()
+        self._out("<</Length %d>>" % len(TO_UNICODE_CMAP))
+        self._putstream(TO_UNICODE_CMAP)
+        self._out("endobj")
+
+        # CIDSystemInfo
+        self._newobj()
+        self._out("<</Registry (Adobe)")
+        self._out("/Ordering (UCS)")
+        self._out("/Supplement 0")
+        self._out(">>")
+        self._out("endobj")
+
+        # Font descriptor
+        self._newobj()
+        self._out("<</Type /FontDescriptor")
+        self._out("/FontName /" + fontname)
+        for name in ("Ascent", "Descent", "CapHeight", "Flags", "FontBBox",
+                     "ItalicAngle", "StemV", "MissingWidth"):
+            value = font["desc"][name]
+            if name == "Flags":
+                # Non-symbolic
+                value = (value | 4) & ~32
+            self._out(" /%s %s" % (name, value))
+        self._out("/FontFile2 %d 0 R" % (self.n + 2))
+        self._out(">>")
+        self._out("endobj")
+
+        # CIDToGIDMap
+        self._newobj()
+        self._out("<</Length %d" % len(cidtogidmap))
+        self._out("/Filter /FlateDecode")
+        self._out(">>")
+        self._putstream(cidtogidmap)
+        self._out("endobj")
+
+        # Font file
+        self._newobj()
+        self._out("<</Length %d" % len(fontstream))
+        self._out("/Filter /FlateDecode")
+        self._out("/Length1 %d" % size)
+        self._out(">>")
+        self._putstream(fontstream)
+        self._out("endobj")
+
+    def font_subset(self, font):
+        """Return the subset of a TrueType font with the glyphs used.
+
+        The subset is returned as (compressed font program, its size,
+        /W widths entry, compressed CIDToGIDMap), and is kept in the
+        cache per font file, set of glyphs and compression level.
+        """
+        subset = sorted(set(font["subset"]) - set([0]))
+        level = max(1, self.compress_level)
+        if self.cache:
+            key = self.cache.key(self.cache.digest(font["ttffile"]), subset,
+                                 level, FPDF_VERSION)
+            data = self.cache.get("font", key)
+            if data is not None:
+                if self.stats:
+                    self.stats.count("font subsets cached")
+                return data
+
+        if self.stats:
+            start = time.time()
+        ttf = TTFontFile()
+        fontstream = ttf.makeSubset(font["ttffile"], subset)
+
+        # FPDF writes the widths straight to the document, they are
+        # caught to be cached. A set makes its lookups in the subset
+        # cheap.
+        widths = []
+        self._out = widths.append
+        try:
+            self._putTTfontwidths(dict(font, subset=set(subset)), ttf.maxUni)
+        finally:
+            del self._out
+
+        cidtogidmap = ["\x00"] * 256 * 256 * 2
+        for cc, glyph in ttf.codeToGlyph.iteritems():
+            cidtogidmap[cc * 2] = chr(glyph >> 8)
+            cidtogidmap[cc * 2 + 1] = chr(glyph & 0xFF)
+
+        program, cidtogidmap = self.compress_streams(
+            [ fontstream, "".join(cidtogidmap) ], level)
+        data = (program, len(fontstream), "".join(widths), cidtogidmap)
+        if self.stats:
+            self.stats.add_time("font subsetting", start)
+        if self.cache:
+            self.cache.put("font", key, data)
+        return data
+
+    def reset_state(self):
+        """Forget the current font and colours.
+
+        Content drawn after this does not depend on what was drawn
+        before it, which is what makes it safe to record and emit.
+        """
+        self.font_family = ""
+        self.set_draw_color(0)
+        self.set_fill_color(0)
+        self.set_text_color(0)
+
+    def begin_record(self):
+        """Lay out what follows into a display list, without output.
+
+        The layout starts at the current position on the current page,
+        and page breaks are recorded instead of made, so the pages
+        after the first are not started until the list is emitted.
+        """
+        self.dlist = DisplayList(self.get_state())
+        self.overflow = False
+
+    def end_record(self):
+        """Stop recording, and return the DisplayList recorded."""
+        dlist = self.dlist
+        dlist.end_state = self.get_state()
+        dlist.overflow = self.overflow
+        self.dlist = None
+        return dlist
+
+    def emit(self, dlist):
+        """Draw a display list on the document.
+
+        The list continues the current page, which is expected to be
+        in the state it was in at begin_record(), as set up by
+        reset_state(). Pages are added where the list breaks them,
+        with their header and footer.
+        """
+        self.set_state(dlist.start_state)
+        self.emitted = []
+        try:
+            self.__emit_ops(dlist.ops, dlist.nums, dlist.args)
+        finally:
+            self.__flush_emitted()
+        self.set_state(dlist.end_state)
+
+    def __flush_emitted(self):
+        # The operators are added to the page at once, rather than
+        # one at a time by _out().
+        if self.emitted:
+            start = len(self.pages[self.page])
+            self.pages[self.page] += "\n".join(self.emitted) + "\n"
+            if self.stream is not None:
+                self.__check_nb(start)
+        self.emitted = None
+
+    def __emit_ops(self, ops, nums, args):
+        k = self.k
+        n = 0
+        a = 0
+        for op in ops:
+            if op == DisplayList.TEXT:
+                # What FPDF.cell() outputs for text without borders,
+                # fill, links or word spacing.
+                txt = args[a]
+                if self.unifontsubset:
+                    self.current_font["subset"].extend(ord(c) for c in txt)
+                    txt = txt.encode("utf-16be")
+                s = "BT %.2f %.2f Td (%s) Tj ET" % (
+                    nums[n] * k, (self.h - nums[n + 1]) * k, self._escape(txt))
+                if self.color_flag:
+                    s = "q " + self.text_color + " " + s + " Q"
+                self.emitted.append(s)
+                n += 2
+                a += 1
+            elif op == DisplayList.FONT:
+                self.__emit_font(args[a], args[a + 1], nums[n],
+                                 int(nums[n + 1]))
+                n += 2
+                a += 2
+            elif op == DisplayList.TEXT_COLOR:
+                self.text_color = args[a]
+                self.color_flag = self.fill_color != self.text_color
+                a += 1
+            elif op == DisplayList.CELL:
+                self.x, self.y, txt, border, align, link = args[a:a + 6]
+                FPDF.cell(self, nums[n], nums[n + 1], txt, border,
+                          int(nums[n + 2]), align, int(nums[n + 3]), link)
+                n += 4
+                a += 6
+            elif op == DisplayList.DRAW_COLOR:
+                FPDF.set_draw_color(self, *nums[n:n + 3])
+                n += 3
+            elif op == DisplayList.FILL_COLOR:
+                FPDF.set_fill_color(self, *nums[n:n + 3])
+                n += 3
+            elif op == DisplayList.LINE_WIDTH:
+                FPDF.set_line_width(self, nums[n])
+                n += 1
+            elif op == DisplayList.IMAGE:
+                x, y, name = args[a:a + 3]
+                self.load_image(name, nums[n])
+                FPDF.image(self, name, x, y, nums[n], nums[n + 1])
+                n += 2
+                a += 3
+            elif op == DisplayList.LINE:
+                FPDF.line(self, *nums[n:n + 4])
+                n += 4
+            elif op == DisplayList.RECT:
+                FPDF.rect(self, *(tuple(nums[n:n + 4]) + (args[a],)))
+                n += 4
+                a += 1
+            elif op == DisplayList.PAGE:
+                self.__flush_emitted()
+                self.set_state(args[a])
+                self.add_page()
+                self.emitted = []
+                a += 1
+
+    def __emit_font(self, family, style, size, underline):
+        self.underline = underline
+        if (family == self.font_family and style == self.font_style
+            and size == self.font_size_pt):
+            return
+        font = self.fonts.get(family + style)
+        if font is None:
+            # A core font not used on this document yet
+            FPDF.set_font(self, family, style + "U" * underline, size)
+            return
+        self.font_family = family
+        self.font_style = style
+        self.font_size_pt = size
+        self.font_size = size / self.k
+        self.current_font = font
+        self.unifontsubset = font["type"] == "TTF"
+        self.emitted.append("BT /F%d %.2f Tf ET" % (font["i"], size))
+
+    def discard_pages(self):
+        """Drop the content of all finished pages, to save memory."""
+        for n in self.pages:
+            if n != self.page:
+                self.pages[n] = ""
+
+    def image(self, name, x=None, y=None, w=0, h=0, type='', link=''):
+        self.load_image(name, w)
+        if self.dlist is not None and not self.dry_run:
+            self.dlist.add(DisplayList.IMAGE, (w, h), (x, y, name))
+            return
+        FPDF.image(self, name, x, y, w, h, type, link)
+
+    def load_image(self, name, width=0):
+        """Register an image without drawing it, and return its info.
+
+        Images with the same content are embedded once, whatever
+        their path. With image_dpi set, an image placed width mm wide
+        is scaled down to that resolution, if it is larger. Parsed
+        images are kept in the cache, keyed by content and size.
+        """
+        if name in self.images:
+            return self.images[name]
+        if self.stats:
+            start = time.time()
+
+        target = self.image_target(width)
+        loaded = None
+        if self.prefetcher:
+            loaded = self.prefetcher.image(name, target)
+
+        if loaded:
+            digest, info = loaded
+        else:
+            digest = self.image_digest(name)
+            info = None
+
+        if (digest, target) in self.image_keys:
+            info = self.image_keys[(digest, target)]
+        else:
+            if info is None:
+                info = self.read_image(name, digest, target)
+            info["i"] = len(self.image_keys) + 1
+            self.image_keys[(digest, target)] = info
+
+            # Done by fpdf when parsing an image with an alpha
+            # channel, which cached images are not.
+            if "smask" in info and self.pdf_version < "1.4":
+                self.pdf_version = "1.4"
+
+        self.images[name] = info
+        if self.stats:
+            self.stats.add_time("image loading", start)
+        return info
+
+    def image_target(self, width):
+        """Return the pixel width of an image placed width mm wide.
+
+        None when images are not scaled down.
+        """
+        if self.image_dpi and width:
+            return int(math.ceil(width / 25.4 * self.image_dpi))
+        return None
+
+    def image_digest(self, name):
+        if self.cache:
+            return self.cache.digest(name)
+        return file_digest(name)
+
+    def read_image(self, name, digest, target):
+        """Read and parse an image, scaled down to target pixels wide.
+
+        Does not change the document, so it can be called from any
+        thread.
+        """
+        info = None
+        cache = self.cache
+        if cache and cache.is_transient(name):
+            cache = None
+        if cache:
+            key = cache.key(digest, target)
+            info = cache.get("image", key)
+        if info is None:
+            info = self.__parse_image(name, target)
+            if cache:
+                cache.put("image", key, info)
+        return info
+
+    def __parse_image(self, name, target):
+        itype = os.path.splitext(name)[1][1:].lower()
+        if itype == "jpeg":
+            itype = "jpg"
+        parse = getattr(self, "_parse" + itype, None)
+        if parse is None:
+            self.error("Unsupported image type: " + itype)
+
+        if target is None or Image is None:
+            return parse(name)
+
+        img = Image.open(name)
+        if img.size[0] <= target:
+            return parse(name)
+
+        # Scale down, and parse a re-encoded copy. JPEG stays JPEG,
+        # everything else becomes PNG.
+        height = max(1, int(round(img.size[1] * float(target) / img.size[0])))
+        if img.mode == "P":
+            img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+        elif img.mode not in ("RGB", "RGBA", "L", "LA", "CMYK"):
+            img = img.convert("RGB")
+        img = img.resize((target, height), Image.ANTIALIAS)
+
+        if itype == "jpg" and img.mode in ("RGB", "L", "CMYK"):
+            fmt, parse = "JPEG", self._parsejpg
+        else:
+            fmt, parse = "PNG", self._parsepng
+
+        fd, tmpname = tempfile.mkstemp("." + fmt.lower())
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                img.save(fp, fmt, quality=90)
+            return parse(tmpname)
+        finally:
+            os.remove(tmpname)
+
+    def add_font_metrics(self, family, style, font_dict):
+        """Register a Unicode TrueType font from pre-parsed metrics.
+
+        Does what add_font(..., uni=True) does, without reading the
+        TTF file or fpdf's per-font pickle.
+        """
+        family = family.lower()
+        style = style.upper()
+        if style == "IB":
+            style = "BI"
+        fontkey = family + style
+        if fontkey in self.fonts:
+            return
+
+        if hasattr(self, "str_alias_nb_pages"):
+            subset = range(0, 57)   # include numbers in the subset!
+        else:
+            subset = range(0, 32)
+
+        ttffile = font_dict["ttffile"]
+        self.fonts[fontkey] = {
+            "i": len(self.fonts) + 1, "type": font_dict["type"],
+            "name": font_dict["name"], "desc": font_dict["desc"],
+            "up": font_dict["up"], "ut": font_dict["ut"],
+            "cw": font_dict["cw"], "ttffile": ttffile,
+            "fontkey": fontkey, "subset": subset, "unifilename": None,
+        }
+        self.font_files[fontkey] = { "length1": font_dict["originalsize"],
+                                     "type": "TTF", "ttffile": ttffile }
+        self.font_files[ttffile] = { "type": "TTF" }
+        self.font_metrics.append((family, style, font_dict))
+
+    def get_state(self):
+        return (self.x, self.y, self.l_margin, self.t_margin, self.r_margin,
+                self.font_family, self.font_style, self.font_size_pt,
+                self.underline, self.draw_color, self.fill_color,
+                self.text_color, self.color_flag, self.line_width)
+
+    def set_state(self, state):
+        (self.x, self.y, self.l_margin, self.t_margin, self.r_margin,
+         self.font_family, self.font_style, self.font_size_pt,
+         self.underline, self.draw_color, self.fill_color,
+         self.text_color, self.color_flag, self.line_width) = state
+
+        self.font_size = self.font_size_pt / self.k
+        fontkey = self.font_family + self.font_style
+        if fontkey in self.fonts:
+            self.current_font = self.fonts[fontkey]
+            self.unifontsubset = (self.current_font["type"] == "TTF")
+
+    def __draw_background(self):
+        # The background is the same on every page. Run the theme
+        # code once, capture the operators it emits into a form
+        # XObject, and reference the XObject from each page.
+        if self.background is None:
+            page = self.pages[self.page]
+            nb_ranges = self.nb_ranges
+            state = self.get_state()
+            self.pages[self.page] = ""
+            exec(self.background_code, { "pdf": self })
+            self.background = self.pages[self.page]
+            self.used_fonts.update(FONT_SELECT_RE.findall(self.background))
+            self.pages[self.page] = page
+            self.nb_ranges = nb_ranges
+            self.set_state(state)
+
+        if self.background:
+            self._out("q /BG Do Q")
+
+    def __put_new_images(self):
+        # Images written out by a streaming document have their data
+        # dropped, put only the ones that still have it.
+        for name, info in sorted(self.images.iteritems(),
+                                 key=lambda item: item[1]["i"]):
+            if "data" in info:
+                self._putimage(info)
+                del info["data"]
+                info.pop("smask", None)
+
+    def _putimages(self):
+        self.__put_new_images()
+
+        if not self.background:
+            return
+
+        if self.compress:
+            filter = "/Filter /FlateDecode "
+            content = zlib.compress(self.background, self.compress_level)
+        else:
+            filter = ""
+            content = self.background
+
+        if self.def_orientation == "P":
+            w_pt, h_pt = self.fw_pt, self.fh_pt
+        else:
+            w_pt, h_pt = self.fh_pt, self.fw_pt
+
+        self._newobj()
+        self.background_n = self.n
+        self._out("<</Type /XObject /Subtype /Form")
+        self._out("/BBox [0 0 %.2f %.2f]" % (w_pt, h_pt))
+        self._out("/Resources 2 0 R")
+        self._out("%s/Length %d>>" % (filter, len(content)))
+        self._putstream(content)
+        self._out("endobj")
+
+    def _putxobjectdict(self):
+        # Images with the same content share their info
+        for i, n in sorted(set((info["i"], info["n"])
+                               for info in self.images.itervalues())):
+            self._out("/I%d %d 0 R" % (i, n))
+        if self.background_n is not None:
+            self._out("/BG %d 0 R" % self.background_n)
+
     def header(self):
-        draw_slide_background = self.theme.get("slide-background", "")
-        exec(draw_slide_background, { "pdf": self })
+        self.__draw_background()
 
         if self.slide_title:
             self.set_text_color(*self.theme["slide-title-color"])
@@ -355,6 +2270,8 @@ class PDF(FPDF):
 
     def footer(self):
         self.set_y(-15)
+        self.set_text_color(*self.theme.get("footer-color",
+                                            self.theme["l0-color"]))
         self.set_font('Arial', 'I', 8)
         self.cell(0, 10, 'Page '+ str(self.page_no())+'/{nb}', 0, 0, 'C')
 
@@ -432,11 +2349,225 @@ class TwoColumnLayout(object):
     def end(self):
         pass
 
+def image_path(image, rpath):
+    try:
+        src = image["src"]
+    except KeyError:
+        raise FormatError("Missing src for image")
+
+    if not os.path.isabs(src):
+        src = os.path.join(rpath, src)
+
+    return src
+
+def slide_images(body, rpath):
+    """Return the paths of the images used in a slide."""
+    return [ image_path(item, rpath) for item in body
+             if isinstance(item, dict) and item.get("type", None) == "image" ]
+
+# Threads of a Prefetcher, and the number of images it loads ahead
+# of the slide being laid out
+PREFETCH_THREADS = 4
+PREFETCH_AHEAD = 8
+
+class Future(object):
+    """The result of a call made on a Prefetcher thread."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def get(self):
+        """Wait for the call, and return its result or raise its error."""
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+class Prefetcher(object):
+    """
+    Loads the assets of slides on a pool of threads, ahead of layout.
+
+    The images of the slides are read and parsed, a few at a time, in
+    the order the slides use them, and the lexers of their code blocks
+    are looked up. The document waits for an image only when it
+    places it, see PDF.load_image(). An image that failed to load
+    raises its error there.
+    """
+
+    def __init__(self, pdf, rpath, threads=PREFETCH_THREADS):
+        self.pdf = pdf
+        self.rpath = rpath
+        self.jobs = Queue.Queue()
+        self.threads = []
+        for i in range(threads):
+            worker = threading.Thread(target=self.__work)
+            worker.daemon = True
+            worker.start()
+            self.threads.append(worker)
+        self.langs = set()
+        self.queue = collections.deque()
+        self.seen = set()
+        self.images = {}
+        self.lock = threading.Lock()
+        self.loaded = set()
+
+    def fetch(self, slides):
+        """Start loading the assets of slides, a list of (title, body)."""
+        for title, body in slides:
+            for item in body:
+                if not isinstance(item, dict):
+                    continue
+                dtype = item.get("type", None)
+                if dtype == "code":
+                    lang = item.get("lang", "text")
+                    if lang not in lexers and lang not in self.langs:
+                        self.langs.add(lang)
+                        self.__submit(self.__load_lexer, lang)
+                elif dtype == "image":
+                    self.__queue_image(item)
+        self.__fill()
+
+    def read_files(self, fnames):
+        """Read files that will be needed later, into the OS cache."""
+        for fname in fnames:
+            self.__submit(self.__read_file, fname)
+
+    def image(self, name, target):
+        """Return (digest, info) of an image, or None if not prefetched.
+
+        Waits for the image if it is still being loaded. info is None
+        for a copy of an image loaded before. An image prefetched for
+        another target width is dropped, and None returned.
+        """
+        slot = self.images.pop(name, None)
+        if slot is None:
+            for key in self.queue:
+                if key[0] == name:
+                    self.queue.remove(key)
+                    break
+            return None
+        self.__fill()
+        loaded_target, result = slot
+        if loaded_target != target:
+            return None
+        return result.get()
+
+    def close(self):
+        """Drop the loads not started yet, and stop the threads."""
+        try:
+            while True:
+                self.jobs.get_nowait()
+        except Queue.Empty:
+            pass
+        for worker in self.threads:
+            self.jobs.put(None)
+        for worker in self.threads:
+            worker.join()
+
+    def __submit(self, func, *args):
+        future = Future()
+        self.jobs.put((future, func, args))
+        return future
+
+    def __work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            future, func, args = job
+            try:
+                future.value = func(*args)
+            except Exception:
+                future.exc_info = sys.exc_info()
+            future.done.set()
+
+    def __queue_image(self, image):
+        try:
+            name = image_path(image, self.rpath)
+        except FormatError:
+            return
+        width = image.get("width", 0)
+        if not isinstance(width, (int, float)):
+            return
+        # Only the first placement of an image is loaded, see
+        # PDF.load_image(), the rest would never free their slot
+        if name not in self.seen and name not in self.pdf.images:
+            self.seen.add(name)
+            self.queue.append((name, self.pdf.image_target(width / 72.0 * 25.4)))
+
+    def __fill(self):
+        while self.queue and len(self.images) < PREFETCH_AHEAD:
+            name, target = self.queue.popleft()
+            self.images[name] = (target,
+                                 self.__submit(self.__load_image, name, target))
+
+    def __load_image(self, name, target):
+        # Copies of an image, under other names, are parsed only once
+        digest = self.pdf.image_digest(name)
+        with self.lock:
+            copy = (digest, target) in self.loaded
+            self.loaded.add((digest, target))
+        if copy or (digest, target) in self.pdf.image_keys:
+            return digest, None
+        return digest, self.pdf.read_image(name, digest, target)
+
+    def __load_lexer(self, lang):
+        # An unknown language is reported when the code is laid out
+        try:
+            get_lexer(lang)
+        except FormatError:
+            pass
+
+    def __read_file(self, fname):
+        try:
+            with open(fname, "rb") as fp:
+                while fp.read(1 << 16):
+                    pass
+        except (IOError, OSError):
+            pass
+
+# The Renderer of a slide rendering worker process
+slides_renderer = None
+
+def slides_init(theme, theme_dir, font_metrics, rpath, cache, fit, image_dpi):
+    global slides_renderer
+    pdf = PDF(theme, theme_dir)
+    pdf.alias_nb_pages()
+    pdf.cache = cache
+    pdf.image_dpi = image_dpi
+    for family, style, font_dict in font_metrics:
+        pdf.add_font_metrics(family, style, font_dict)
+    pdf.prefetcher = Prefetcher(pdf, rpath)
+    slides_renderer = Renderer(pdf, rpath, cache, fit=fit)
+
+def slides_render(slides):
+    slides_renderer.pdf.prefetcher.fetch(slides)
+    dlists = [ slides_renderer.layout_slide(title, body)
+               for title, body in slides ]
+    slides_renderer.pdf.discard_pages()
+    return dlists
+
+# Smallest text scale tried to fit a slide, and the number of steps
+# of the search for the largest scale that fits
+MIN_TEXT_SCALE = 0.5
+FIT_STEPS = 6
+
 class Renderer(object):
-    def __init__(self, pdf, rpath):
+    def __init__(self, pdf, rpath, cache=None, cache_key=None, jobs=1,
+                 fit=False):
         self.pdf = pdf
         self.slides = None
         self.rpath = rpath
+        self.cache = cache
+        self.cache_key = cache_key
+        self.jobs = jobs
+        self.pool = None
+        self.fonts_read = False
+        self.fit = fit
+        # (title, text scale, pages) of slides that did not fit
+        self.overflows = []
 
     def __box_text(self, box, text):
         (box_x, box_y, box_w, box_h), box_align, box_font, (box_color) = box
@@ -452,8 +2583,13 @@ class Renderer(object):
         self.__box_text(self.pdf.theme["author-box"], meta["author"])
         self.__box_text(self.pdf.theme["email-box"], meta["email"])
 
-    def render_section(self):
-        pass
+    def render_section(self, title):
+        self.pdf.set_slide_title(None)
+        self.pdf.set_image(None)
+        self.pdf.add_page()
+        self.__box_text(self.pdf.theme.get("section-box",
+                                           self.pdf.theme["title-box"]),
+                        title)
 
     def render_slideset(self, slideset):
         self.slides = slideset
@@ -467,6 +2603,7 @@ class Renderer(object):
                              self.pdf.theme["tmargin-slide"])
         self.pdf.set_image(None)
         self.pdf.add_page()
+        self.pdf.reset_state()
         self.pdf.set_slide_title("%s (Contd)" % title)
         self.list = None
         self.layout = SimpleLayout(self.pdf)
@@ -475,7 +2612,7 @@ class Renderer(object):
         if isinstance(item, list):
             self.__gen_list(item)
         else:
-            self.list.start_item(i == 0)
+            self.list.start_item()
             self.list.write(item)
 
         if not isinstance(next_item, list):
@@ -483,7 +2620,7 @@ class Renderer(object):
 
     def __gen_list(self, items):
         self.layout.start(None)
-        self.list = List(self.pdf, "*", len(items), self.list)
+        self.list = List(self.pdf, "*", self.list)
 
         for i, (item, next_item) in enumerate(pairwise(items)):
             self.__gen_item(i, item, next_item)
@@ -492,13 +2629,7 @@ class Renderer(object):
         self.layout.end()
 
     def __gen_image(self, image):
-        try:
-            src = image["src"]
-        except KeyError:
-            raise FormatError("Missing src for image")
-        
-        if not os.path.isabs(src):
-            src = os.path.join(self.rpath, src)
+        src = image_path(image, self.rpath)
             
         width = image.get("width", 0)
         height = image.get("height", 0)
@@ -521,22 +2652,48 @@ class Renderer(object):
             raise FormatError("Invalid layout mode '%s'", layout["mode"])
 
     def __gen_table(self, table):
-        pass
+        rows = table.get("rows", None)
+        if not rows or not isinstance(rows, list):
+            raise FormatError("Missing 'rows' attribute in element 'table'")
+
+        cells = []
+        for row in rows:
+            if not isinstance(row, list):
+                raise FormatError("Expected list for table row, found %s"
+                                  % type(row))
+            cells.append([ table_cell(cell) for cell in row ])
+        if not any(cells):
+            raise FormatError("Table without columns, all rows are empty")
+
+        header = table.get("header", 1)
+        if (not isinstance(header, int) or isinstance(header, bool) or
+            header < 0):
+            raise FormatError("Invalid 'header' in element 'table', expected"
+                              " the number of header rows")
+
+        align = table.get("align", [])
+        if (not isinstance(align, list) or
+            any(a not in ("L", "C", "R") for a in align)):
+            raise FormatError("Invalid 'align' in element 'table', expected"
+                              " a list of L, C or R")
+
+        pos = table.get("pos", None)
+
+        self.layout.start(pos)
+        Table(self.pdf, cells, header, align)
+        self.layout.end()
 
     def __gen_code(self, code):
         if not "code" in code:
             raise FormatError("Missing 'code' attribute in element 'code'")
 
         lang = code.get("lang", "text")
-        try:
-            lexer = pygments.lexers.get_lexer_by_name(lang)
-        except pygments.util.ClassNotFound:
-            raise FormatError("Unknown 'lang' '%s'" % lang)
+        get_lexer(lang)
 
         pos = code.get("pos", None)
 
         self.layout.start(pos)
-        Code(self.pdf, code, lexer)
+        Code(self.pdf, code, lang, self.cache)
         self.layout.end()
 
     def __gen_text(self, text):
@@ -550,11 +2707,13 @@ class Renderer(object):
         self.layout.end()
 
     def __gen_one_slide(self, title, body):
-        self.__new_slide(title)
-        
+        stats = self.pdf.stats
         for i, item in enumerate(body):
             if isinstance(item, dict):
                 dtype = item.get("type", None)
+                if stats:
+                    start = time.time()
+
                 if dtype == "image":
                     self.__gen_image(item)
                 elif dtype == "layout":
@@ -569,12 +2728,171 @@ class Renderer(object):
                     raise FormatError("Missing element type")
                 else:
                     raise FormatError("Unknown element type: %s", dtype)
+
+                if stats:
+                    stats.add_time(dtype, start)
             else:
                 raise FormatError("Expected map found %s" % type(item))
 
-    def __gen_slides(self):
-        for title, body in self.slides.iteritems():
+    def __gen_body(self, title, body):
+        # Lay out the slide at the text scale that fits, returns the
+        # scale.
+        scale = 1.0
+        if self.fit:
+            scale = self.__fit_scale(title, body)
+
+        self.pdf.text_scale = scale
+        try:
+            self.__gen_one_slide(title, body)
+        finally:
+            self.pdf.text_scale = 1.0
+        return scale
+
+    def __fit_scale(self, title, body):
+        # The largest scale at which the slide fits, found by bisection.
+        # A slide that does not fit at any scale, like one with an
+        # image taller than the page, is left as it is.
+        if not self.__overflows(title, body, 1.0):
+            return 1.0
+        if self.__overflows(title, body, MIN_TEXT_SCALE):
+            return 1.0
+
+        fits = MIN_TEXT_SCALE
+        overflows = 1.0
+        for i in range(FIT_STEPS):
+            scale = (fits + overflows) / 2
+            if self.__overflows(title, body, scale):
+                overflows = scale
+            else:
+                fits = scale
+        return fits
+
+    def __overflows(self, title, body, scale):
+        self.pdf.text_scale = scale
+        self.pdf.begin_dry_run()
+        try:
             self.__gen_one_slide(title, body)
+        finally:
+            overflow = self.pdf.end_dry_run()
+            self.list = None
+            self.layout = SimpleLayout(self.pdf)
+        return overflow
+
+    def __slide_key(self, title, body):
+        # Everything the rendered slide depends on: the theme and code
+        # (in cache_key), the slide source and the referenced images.
+        images = []
+        for src in slide_images(body, self.rpath):
+            try:
+                images.append((src, self.cache.digest(src)))
+            except (IOError, OSError):
+                return None
+        return self.cache.key(self.cache_key, self.fit, self.pdf.image_dpi,
+                              title, body, images)
+
+    def layout_slide(self, title, body):
+        """Start a slide, and return the DisplayList of its body.
+
+        The display list also has the text scale used to fit the slide.
+        """
+        self.__new_slide(title)
+        self.pdf.begin_record()
+        try:
+            scale = self.__gen_body(title, body)
+        finally:
+            dlist = self.pdf.end_record()
+        dlist.scale = scale
+        return dlist
+
+    def __render_parallel(self, pool, slides):
+        # Lay out slides in worker processes, in chunks small enough to
+        # keep all the workers busy. The display lists are emitted into
+        # this document in order, as they arrive.
+        chunk = max(1, len(slides) // (self.jobs * 4))
+        chunks = [ slides[i:i + chunk] for i in range(0, len(slides), chunk) ]
+
+        for dlists in pool.imap(slides_render, chunks):
+            for dlist in dlists:
+                yield dlist
+
+    def __gen_slides(self):
+        slides = self.slides.items()
+
+        keys = [ None ] * len(slides)
+        dlists = [ None ] * len(slides)
+        if self.cache_key:
+            for i, (title, body) in enumerate(slides):
+                keys[i] = self.__slide_key(title, body)
+                if keys[i]:
+                    dlists[i] = self.cache.get("slide", keys[i])
+
+        pending = [ slides[i] for i, dlist in enumerate(dlists)
+                    if dlist is None ]
+
+        # The worker processes are forked before any prefetch thread
+        # is started, and are kept for the following slide sets.
+        rendered = None
+        if self.jobs > 1 and pending:
+            if self.pool is None:
+                args = (self.pdf.theme, self.pdf.theme_dir,
+                        self.pdf.font_metrics, self.rpath, self.cache,
+                        self.fit, self.pdf.image_dpi)
+                import multiprocessing
+                self.pool = multiprocessing.Pool(self.jobs, slides_init, args)
+            rendered = self.__render_parallel(self.pool, pending)
+
+        # The font files are read when the document is closed
+        prefetcher = Prefetcher(self.pdf, self.rpath)
+        if not self.fonts_read:
+            prefetcher.read_files(font_dict["ttffile"]
+                                  for family, style, font_dict
+                                  in self.pdf.font_metrics)
+            self.fonts_read = True
+        prefetcher.fetch(slides)
+        self.pdf.prefetcher = prefetcher
+
+        try:
+            for (title, body), key, dlist in zip(slides, keys, dlists):
+                if self.pdf.stats:
+                    start = time.time()
+
+                if dlist is None and rendered is not None:
+                    dlist = rendered.next()
+                    if key:
+                        self.cache.put("slide", key, dlist)
+
+                first_page = self.pdf.page + 1
+                if dlist is not None:
+                    self.__new_slide(title)
+                else:
+                    dlist = self.layout_slide(title, body)
+                    if key:
+                        self.cache.put("slide", key, dlist)
+
+                if self.pdf.stats:
+                    emit_start = time.time()
+                self.pdf.emit(dlist)
+                if self.pdf.stats:
+                    self.pdf.stats.add_time("emitting", emit_start)
+
+                # Pages tables were planned to run on are not reported
+                pages = self.pdf.page - first_page + 1
+                unplanned = pages - dlist.planned_pages
+                if dlist.scale < 1.0 or unplanned > 1 or dlist.overflow:
+                    self.overflows.append((title, dlist.scale, unplanned,
+                                           dlist.overflow))
+                if self.pdf.stats:
+                    self.pdf.stats.add_slide(title, start, pages)
+        finally:
+            self.pdf.prefetcher = None
+            prefetcher.close()
+
+    def close(self):
+        """Stop the worker processes, if any."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
 
 def error(msg):
     sys.stderr.write("peacock: ")
@@ -582,42 +2900,466 @@ def error(msg):
     sys.stderr.write("\n")
     exit(1)
 
+def warning(msg):
+    sys.stderr.write("peacock: warning: ")
+    sys.stderr.write(msg)
+    sys.stderr.write("\n")
+
+def read_font_metrics(fname):
+    """Parse a TrueType font into the metrics dict fpdf works with.
+
+    The glyph width table is packed into a string, which pickles and
+    unpickles far faster than a list of 65536 ints.
+    """
+    ttf = TTFontFile()
+    ttf.getMetrics(fname)
+    desc = {
+        "Ascent": int(round(ttf.ascent, 0)),
+        "Descent": int(round(ttf.descent, 0)),
+        "CapHeight": int(round(ttf.capHeight, 0)),
+        "Flags": ttf.flags,
+        "FontBBox": "[%s %s %s %s]" % tuple(int(round(b, 0)) for b in ttf.bbox),
+        "ItalicAngle": int(ttf.italicAngle),
+        "StemV": int(round(ttf.stemV, 0)),
+        "MissingWidth": int(round(ttf.defaultWidth, 0)),
+    }
+    return {
+        "name": re.sub("[ ()]", "", ttf.fullName),
+        "type": "TTF",
+        "desc": desc,
+        "up": round(ttf.underlinePosition),
+        "ut": round(ttf.underlineThickness),
+        "ttffile": fname,
+        "originalsize": os.stat(fname).st_size,
+        "cw": array.array("I", ttf.charWidths).tostring(),
+    }
+
+# Number of slides listed by the --stats report
+STATS_SLOWEST = 10
+
+class Stats(object):
+    """
+    Timings and counters of a build.
+
+    The time of each phase of the build is always kept. With detail
+    set, so are the time of each slide, and of each kind of element
+    and work, and the counters. The code that collects the details
+    checks pdf.stats, which is None without them, so they cost close
+    to nothing when not asked for.
+    """
+
+    def __init__(self, detail=False):
+        self.detail = detail
+        self.phases = OrderedDict()
+        # name -> [calls, seconds]
+        self.times = {}
+        self.counters = {}
+        # (seconds, title, pages) of each slide
+        self.slides = []
+
+    def add_phase(self, phase, start):
+        self.phases[phase] = self.phases.get(phase, 0) + time.time() - start
+
+    def add_time(self, name, start):
+        entry = self.times.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += time.time() - start
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_slide(self, title, start, pages):
+        self.slides.append((time.time() - start, title, pages))
+
+    def as_dict(self):
+        return {
+            "phases": self.phases,
+            "times": dict((name, { "calls": calls, "seconds": secs })
+                          for name, (calls, secs) in self.times.iteritems()),
+            "counters": self.counters,
+            "slides": [ { "title": title, "seconds": secs, "pages": pages }
+                        for secs, title, pages in self.slides ],
+        }
+
+    def report(self, fp, name):
+        """Write a summary, slowest first, to fp."""
+        total = sum(self.phases.itervalues())
+        fp.write("peacock: %s built in %.2fs\n" % (name, total))
+
+        fp.write("  %-22s %8s %6s\n" % ("phase", "seconds", "%"))
+        for phase, secs in sorted(self.phases.iteritems(),
+                                  key=lambda item: -item[1]):
+            fp.write("  %-22s %8.3f %6.1f\n"
+                     % (phase, secs, secs * 100 / max(total, 1e-9)))
+
+        if self.times:
+            fp.write("\n  %-22s %8s %6s\n" % ("work", "seconds", "calls"))
+            for work, (calls, secs) in sorted(self.times.iteritems(),
+                                              key=lambda item: -item[1][1]):
+                fp.write("  %-22s %8.3f %6d\n" % (work, secs, calls))
+
+        if self.slides:
+            fp.write("\n  %-22s %8s %6s\n" % ("slowest slides", "seconds", "pages"))
+            for secs, title, pages in sorted(self.slides,
+                                             key=lambda slide: -slide[0])[:STATS_SLOWEST]:
+                if isinstance(title, unicode):
+                    title = title.encode("utf-8")
+                fp.write("  %-22s %8.3f %6d\n" % (title[:22], secs, pages))
+
+        if self.counters:
+            fp.write("\n")
+        for counter, value in sorted(self.counters.iteritems()):
+            fp.write("  %-22s %8d\n" % (counter, value))
+
+# Port of --serve on localhost
+SERVE_PORT = 8080
+# Requests of --serve that may wait for a worker
+SERVE_QUEUE = 16
+# Seconds a --serve request may take, from when it is accepted
+SERVE_TIMEOUT = 60
+# Seconds to wait for a worker past the timeout, which it enforces
+SERVE_GRACE = 5
+# Seconds a client may take to send a request, or to read the reply
+SERVE_IO_TIMEOUT = 60
+# Largest presentation, with its files, accepted by --serve
+SERVE_MAX_BODY = 64 * 1024 * 1024
+# Content types of a presentation posted as a tar archive
+SERVE_ARCHIVE_TYPES = ("application/x-tar", "application/x-gtar",
+                       "application/gzip", "application/x-gzip")
+SERVE_YAML_TYPES = ("application/x-yaml", "application/yaml", "text/yaml",
+                    "text/x-yaml")
+# Rendered requests whose latency is kept for the --serve metrics
+SERVE_LATENCIES = 1000
+# Seconds over which the current throughput of --serve is measured
+SERVE_WINDOW = 60
+
+# Seconds between checks for changed files in watch mode
+WATCH_INTERVAL = 0.5
+
 class Peacock(object):
-    def __init__(self):
+    def __init__(self, cache=None):
         self.infname = None
         self.outfname = None
         self.theme_dir = None
         self.theme = None
+        self.theme_fonts = None
+        self.theme_key = None
+        self.cache = cache
+        self.incremental = False
+        self.stream = False
+        self.fit = False
+        self.image_dpi = None
+        self.compress_level = COMPRESS_LEVEL
+        self.jobs = 1
         self.pdf = None
         self.meta = None
-        self.slideset = None
+        self.documents = None
+        # Timings of the last build, see Stats
+        self.stats = Stats()
+        self.stats_detail = False
+        self.stats_json = None
+        # Images used by the slides rendered so far
+        self.images = []
 
     def main(self, infname, outfname, theme_dir):
         self.infname = infname
         self.outfname = outfname
         self.theme_dir = theme_dir
 
+        self.stats = Stats(self.stats_detail)
         self.init_theme()
+        self.build()
+        self.report_stats()
+
+    def build(self):
+        start = time.time()
         self.pdf = PDF(self.theme, self.theme_dir)
         self.pdf.alias_nb_pages()
+        self.pdf.cache = self.cache
+        self.pdf.image_dpi = self.image_dpi
+        self.pdf.set_compress_level(self.compress_level)
+        self.pdf.compress_jobs = self.jobs
+        if self.stats.detail:
+            self.pdf.stats = self.stats
         self.init_theme_fonts()
+        self.images = []
+        self.stats.add_phase("setup", start)
         self.init_presentation()
         self.init_pdf_metainfo()
         self.render()
 
+        if self.stats.detail:
+            self.stats.count("pages", self.pdf.page)
+            self.stats.count("images embedded", len(self.pdf.image_keys))
+            self.stats.count("bytes written", os.stat(self.outfname).st_size)
+
+    def report_stats(self):
+        if self.stats_detail and not self.stats_json:
+            self.stats.report(sys.stderr, self.infname)
+        if self.stats_json == "-":
+            json.dump(self.stats.as_dict(), sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        elif self.stats_json:
+            with open(self.stats_json, "w") as fp:
+                json.dump(self.stats.as_dict(), fp, indent=2)
+
+    def watch(self, infname, outfname, theme_dir):
+        """Re-build the presentation whenever one of its files changes.
+
+        The theme and everything imported stay loaded between builds,
+        so a re-build only pays for parsing and layout.
+        """
+        self.infname = infname
+        self.outfname = outfname
+        self.theme_dir = theme_dir
+
+        stamps = {}
+        while True:
+            new_stamps = self.__stamps(self.__watched_files())
+            if new_stamps != stamps:
+                theme_changed = (self.theme is None or
+                                 self.__theme_stamps(new_stamps) !=
+                                 self.__theme_stamps(stamps))
+                start = time.time()
+                self.stats = Stats(self.stats_detail)
+                try:
+                    if theme_changed:
+                        self.init_theme()
+                    self.build()
+                    print "peacock: wrote %s in %.2fs" % (self.outfname,
+                                                          time.time() - start)
+                    self.report_stats()
+                except (FormatError, ThemeError, RuntimeError,
+                        EnvironmentError) as e:
+                    sys.stderr.write("peacock: %s\n" % e)
+                except Exception as e:
+                    # A mistake made while editing, like a missing meta
+                    # field, is reported, and the next save re-builds
+                    sys.stderr.write("peacock: %s: %s\n" % (type(e).__name__, e))
+                sys.stdout.flush()
+
+                # The build may have found new images to watch. Files
+                # seen before keep the stamp they had before the build,
+                # so changes made during the build are not lost.
+                stamps = self.__stamps(self.__watched_files())
+                stamps.update(new_stamps)
+
+            time.sleep(WATCH_INTERVAL)
+
+    def build_deck(self, infname, outfname):
+        self.infname = infname
+        self.outfname = outfname
+        self.stats = Stats(self.stats_detail)
+        if self.theme is None:
+            self.init_theme()
+        self.build()
+
+    def batch(self, theme_dir, decks, jobs=1):
+        """Build many presentations with the same theme.
+
+        decks is a list of (input, output) file names. The theme is
+        loaded once per process, and with jobs > 1 the presentations
+        are built in a pool of worker processes. A failure is reported
+        and does not stop the batch. Returns the number of failures.
+        """
+        self.theme_dir = theme_dir
+        cache_dir = self.cache.dirname if self.cache else None
+        args = (cache_dir, self.incremental, self.stream, self.fit,
+                self.image_dpi, self.compress_level, theme_dir)
+
+        if jobs > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(jobs, batch_init, args)
+            results = pool.imap(batch_build, decks)
+        else:
+            global batch_peacock
+            batch_peacock = self
+            pool = None
+            results = itertools.imap(batch_build, decks)
+
+        failed = 0
+        for infname, outfname, err, elapsed in results:
+            if err is None:
+                print "ok     %s -> %s (%.2fs)" % (infname, outfname, elapsed)
+            else:
+                print "FAILED %s: %s" % (infname, err)
+                failed += 1
+            sys.stdout.flush()
+
+        if pool:
+            pool.close()
+            pool.join()
+
+        print "%d built, %d failed" % (len(decks) - failed, failed)
+        return failed
+
+    def serve(self, theme_dirs, port=SERVE_PORT, jobs=None,
+              queue_size=SERVE_QUEUE, timeout=SERVE_TIMEOUT):
+        """Render presentations posted over HTTP on localhost.
+
+        The themes are loaded here, to check them and to cache them,
+        and by each of jobs worker processes, one per CPU by default,
+        that render the presentations. See RenderServer. Runs until
+        interrupted.
+        """
+        import multiprocessing
+
+        themes = {}
+        for theme_dir in theme_dirs:
+            name = os.path.basename(os.path.normpath(theme_dir))
+            if name in themes:
+                raise ThemeError("more than one theme named '%s'" % name)
+            self.theme_dir = theme_dir
+            self.init_theme()
+            themes[name] = theme_dir
+
+        jobs = jobs or multiprocessing.cpu_count()
+        server = render_server_class()(port, themes, jobs, queue_size, timeout)
+        cache_dir = self.cache.dirname if self.cache else None
+        args = (cache_dir, self.incremental, self.stream, self.fit,
+                self.image_dpi, self.compress_level, theme_dirs)
+        server.pool = multiprocessing.Pool(jobs, serve_init, args)
+
+        print "peacock: serving %s on http://127.0.0.1:%d/ with %d workers" % (
+            ", ".join(sorted(themes)), server.server_port, jobs)
+        sys.stdout.flush()
+        try:
+            # Stopping the server stops the workers too
+            signal.signal(signal.SIGTERM, serve_stop)
+            server.serve_forever()
+        finally:
+            server.server_close()
+            server.pool.terminate()
+            server.pool.join()
+
+    def __theme_files(self):
+        return [ os.path.join(self.theme_dir, fname)
+                 for fname in sorted(os.listdir(self.theme_dir)) ]
+
+    def __watched_files(self):
+        return [ self.infname ] + self.images + self.__theme_files()
+
+    def __theme_stamps(self, stamps):
+        # Files added to the theme show up as a change too
+        theme_files = set(self.__theme_files())
+        return dict((fname, stamp) for fname, stamp in stamps.iteritems()
+                    if fname in theme_files)
+
+    def __stamps(self, files):
+        stamps = {}
+        for fname in files:
+            try:
+                st = os.stat(fname)
+                stamps[fname] = (st.st_size, st.st_mtime)
+            except OSError:
+                stamps[fname] = None
+        return stamps
+
     def render(self):
-        renderer = Renderer(self.pdf, os.path.dirname(self.infname))
+        # Write to a temporary file and rename it, so that a viewer
+        # never sees a half written presentation.
+        tmpfname = "%s.%d.tmp" % (self.outfname, os.getpid())
+        try:
+            if self.stream:
+                with open(tmpfname, "wb") as fp:
+                    self.pdf.begin_stream(fp)
+                    self.render_slides()
+                    start = time.time()
+                    self.pdf.close()
+            else:
+                self.render_slides()
+                start = time.time()
+                self.pdf.output(tmpfname, 'F')
+            os.rename(tmpfname, self.outfname)
+            self.stats.add_phase("output", start)
+        finally:
+            if os.path.exists(tmpfname):
+                os.remove(tmpfname)
+
+    def render_slides(self):
+        # Parsing is done while laying out, it is not counted as layout
+        start = time.time()
+        parse_start = self.stats.phases.get("parse", 0)
+
+        rpath = os.path.dirname(self.infname)
+        # The code and slides of a presentation that is gone after the
+        # build are not cached, they would only fill the cache.
+        cache = self.cache
+        if cache and cache.is_transient(self.infname):
+            cache = None
+        cache_key = None
+        if self.incremental and cache:
+            import pygments
+            code_key = cache.digest(os.path.abspath(__file__))
+            cache_key = cache.key(self.theme_key, code_key,
+                                  pygments.__version__,
+                                  self.__markdown_key())
+        renderer = Renderer(self.pdf, rpath, cache, cache_key, self.jobs,
+                            self.fit)
         renderer.render_title(self.meta)
-        renderer.render_slideset(self.slideset)
-        self.pdf.output(self.outfname, 'F')
+        try:
+            for doc in self.documents:
+                if doc is None:
+                    continue
+                if is_section(doc):
+                    renderer.render_section(doc["section"])
+                elif isinstance(doc, dict):
+                    for body in doc.itervalues():
+                        try:
+                            self.images.extend(slide_images(body, rpath))
+                        except FormatError:
+                            pass
+                    renderer.render_slideset(doc)
+                else:
+                    raise FormatError("expected a slide set or a section, found %s"
+                                      % type(doc))
+        finally:
+            renderer.close()
+            self.documents.close()
+            self.stats.add_phase("layout", start)
+            self.stats.phases["layout"] -= (self.stats.phases.get("parse", 0)
+                                            - parse_start)
+
+        for title, scale, pages, overflow in renderer.overflows:
+            if overflow:
+                warning("%s: slide '%s' does not fit, it runs off the bottom"
+                        " of the page" % (self.infname, title))
+            if pages > 1:
+                warning("%s: slide '%s' does not fit, continued on %d more page(s)"
+                        % (self.infname, title, pages - 1))
+            elif not overflow:
+                warning("%s: slide '%s' text scaled to %d%% to fit"
+                        % (self.infname, title, round(scale * 100)))
+
+    def __markdown_key(self):
+        # Importing markdown, or its version, takes longer than a
+        # build from cached slides, its package is hashed instead.
+        import imp
+        fp, path, desc = imp.find_module("markdown")
+        return [ self.cache.digest(os.path.join(path, fname))
+                 for fname in sorted(os.listdir(path))
+                 if fname.endswith(".py") ]
 
     def init_presentation(self):
+        # The slide sets are parsed as they are rendered
+        self.documents = self.__documents()
+        self.meta = next(self.documents, None)
+        if self.meta is None:
+            raise FormatError("'%s' has no meta information" % self.infname)
+
+    def __documents(self):
+        docs = load_source(self.infname, self.cache)
         try:
-            with open(self.infname) as fp:
-                pt = yaml.load_all(fp, Loader=OrderedDictYAMLLoader)
-                self.meta = pt.next()
-                self.slideset = pt.next()
-        except IOError as e:
+            while True:
+                start = time.time()
+                try:
+                    doc = docs.next()
+                except StopIteration:
+                    return
+                finally:
+                    self.stats.add_phase("parse", start)
+                yield doc
+        except EnvironmentError as e:
             raise FormatError("error opening file '%s': %s" % (self.infname, e))
         except yaml.MarkedYAMLError as e:
             raise FormatError("error parsing '%s': %s" % (self.infname, e))
@@ -644,20 +3386,58 @@ class Peacock(object):
         self.pdf.set_keywords(keywords)
         self.pdf.set_creator("peacock")
 
+    def __theme_digest(self):
+        # Content hash of every file in the theme, so that the cached
+        # bundle is invalidated when any of them changes.
+        h = hashlib.sha1(os.path.abspath(self.theme_dir))
+        try:
+            for fname in sorted(os.listdir(self.theme_dir)):
+                path = os.path.join(self.theme_dir, fname)
+                if fname.endswith(".pkl") or not os.path.isfile(path):
+                    continue
+                h.update(fname)
+                h.update(self.cache.digest(path))
+        except (IOError, OSError) as e:
+            raise ThemeError("error reading theme: %s" % e)
+        return h.hexdigest()
+
     def init_theme(self):
+        start = time.time()
+        # Without a cache, the theme is not looked up, or hashed
+        self.theme_key = None
+        bundle = None
+        if self.cache:
+            self.theme_key = self.__theme_digest()
+            bundle = self.cache.get("theme", self.theme_key)
+
+        if bundle is None:
+            theme = self.load_theme()
+            bundle = { "theme": theme, "fonts": self.load_theme_fonts(theme) }
+            if self.cache:
+                self.cache.put("theme", self.theme_key, bundle)
+
+        self.theme = bundle["theme"]
+        # The font files may have changed since they were measured
+        string_widths.clear()
+        self.theme_fonts = []
+        for name, style, font_dict in bundle["fonts"]:
+            font_dict = dict(font_dict, cw=array.array("I", font_dict["cw"]))
+            self.theme_fonts.append((name, style, font_dict))
+        self.stats.add_phase("theme", start)
+
+    def load_theme(self):
         try:
             info_fname = os.path.join(self.theme_dir, "info.yaml")
             with open(info_fname) as fp:
-                self.theme = yaml.load(fp)
+                return yaml.load(fp)
         except IOError as e:
             raise ThemeError("error opening file: %s" % e)
         except yaml.MarkedYAMLError as e:
             raise ThemeError("error parsing '%s': %s" % (info_fname, e))
 
-    def init_theme_fonts(self):
-        fpdf.set_global("FPDF_FONT_DIR", self.theme_dir)
-
-        for finfo in self.theme.get("fonts", []):
+    def load_theme_fonts(self, theme):
+        fonts = []
+        for finfo in theme.get("fonts", []):
             try:
                 name, style, fname = finfo
             except ValueError:
@@ -666,26 +3446,650 @@ class Peacock(object):
             if style not in [ "B", "I", "BI", "IB", "" ]:
                 raise ThemeError("invalid style in 'fonts' - '%s'" % style)
 
-            fname = os.path.join(self.theme_dir, fname)
+            fname = os.path.abspath(os.path.join(self.theme_dir, fname))
             if not os.path.exists(fname):
                 raise ThemeError("font file '%s' not found" % fname)
 
-            self.pdf.add_font(name, style, fname, uni=True)
+            fonts.append((name, style, read_font_metrics(fname)))
+        return fonts
+
+    def init_theme_fonts(self):
+        for name, style, font_dict in self.theme_fonts:
+            self.pdf.add_font_metrics(name, style, font_dict)
+
+# The Peacock instance of a batch worker process
+batch_peacock = None
+
+def batch_init(cache_dir, incremental, stream, fit, image_dpi, compress_level,
+               theme_dir):
+    global batch_peacock
+    cache = DiskCache(cache_dir) if cache_dir else None
+    batch_peacock = Peacock(cache)
+    batch_peacock.incremental = incremental
+    batch_peacock.stream = stream
+    batch_peacock.fit = fit
+    batch_peacock.image_dpi = image_dpi
+    batch_peacock.compress_level = compress_level
+    batch_peacock.theme_dir = theme_dir
+
+def batch_build(deck):
+    infname, outfname = deck
+    start = time.time()
+    try:
+        batch_peacock.build_deck(infname, outfname)
+    except (FormatError, ThemeError, RuntimeError, EnvironmentError) as e:
+        return infname, outfname, str(e), time.time() - start
+    except Exception as e:
+        # Whatever goes wrong with one presentation, the rest are built
+        return (infname, outfname, "%s: %s" % (type(e).__name__, e),
+                time.time() - start)
+    return infname, outfname, None, time.time() - start
+
+def batch_decks(patterns, manifest=None, output_dir=None):
+    """Return the (input, output) pairs to build in batch mode.
+
+    Inputs are given as file names or glob patterns, and the output
+    is the input with a .pdf extension, in output_dir if given. A
+    manifest file lists one input per line, optionally followed by
+    its output; paths in it are relative to the manifest.
+    """
+    def output_for(infname):
+        outfname = os.path.splitext(infname)[0] + ".pdf"
+        if output_dir:
+            outfname = os.path.join(output_dir, os.path.basename(outfname))
+        return outfname
+
+    decks = []
+    if manifest:
+        mdir = os.path.dirname(manifest)
+        try:
+            with open(manifest) as fp:
+                lines = fp.readlines()
+        except IOError as e:
+            raise FormatError("error opening manifest: %s" % e)
+
+        for line in lines:
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            if len(fields) > 2:
+                raise FormatError("invalid manifest line, fmt: <input> [<output>]")
+            infname = os.path.join(mdir, fields[0])
+            if len(fields) == 2:
+                outfname = os.path.join(mdir, fields[1])
+            else:
+                outfname = output_for(infname)
+            decks.append((infname, outfname))
+
+    for pattern in patterns:
+        fnames = sorted(glob.glob(pattern)) or [ pattern ]
+        for infname in fnames:
+            decks.append((infname, output_for(infname)))
+
+    return decks
+
+def percentile(values, pct):
+    """Return the pct percentile of sorted values, by nearest rank."""
+    if not values:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+class ServeStats(object):
+    """
+    Counters and latencies of the requests to a RenderServer.
+
+    The latency of the last SERVE_LATENCIES rendered requests is kept,
+    with the part of it spent waiting for a worker and rendering.
+    Throughput is measured over the last SERVE_WINDOW seconds, and
+    since the server started. Requests are handled by threads, so
+    everything is updated under a lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = OrderedDict((name, 0) for name in
+                                    ("requests", "rendered", "failed",
+                                     "rejected", "timed out"))
+        # (latency, wait, render) of each rendered request
+        self.latencies = collections.deque(maxlen=SERVE_LATENCIES)
+        # When the rendered requests in the window were done
+        self.done = collections.deque()
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def add_render(self, latency, wait, render):
+        now = time.time()
+        with self.lock:
+            self.counters["rendered"] += 1
+            self.latencies.append((latency, wait, render))
+            self.done.append(now)
+            self.__expire(now)
+
+    def __expire(self, now):
+        while self.done and self.done[0] < now - SERVE_WINDOW:
+            self.done.popleft()
+
+    def as_dict(self):
+        now = time.time()
+        with self.lock:
+            self.__expire(now)
+            uptime = now - self.started
+            seconds = OrderedDict()
+            for i, name in enumerate(("latency", "wait", "render")):
+                values = sorted(entry[i] for entry in self.latencies)
+                seconds[name] = OrderedDict([
+                    ("mean", sum(values) / max(len(values), 1)),
+                    ("p50", percentile(values, 50)),
+                    ("p90", percentile(values, 90)),
+                    ("p99", percentile(values, 99)),
+                    ("max", values[-1] if values else 0.0),
+                ])
+            return OrderedDict([
+                ("uptime", uptime),
+                ("counters", OrderedDict(self.counters)),
+                ("throughput", OrderedDict([
+                    ("current", len(self.done) / max(min(uptime, SERVE_WINDOW), 1e-9)),
+                    ("overall", self.counters["rendered"] / max(uptime, 1e-9)),
+                ])),
+                ("seconds", seconds),
+            ])
+
+def render_server_class():
+    """Define and return the RenderServer class, see --serve.
+
+    The HTTP server modules it is built on are imported here, no other
+    command needs them.
+    """
+    import BaseHTTPServer
+    import shutil
+    import SocketServer
+    import urlparse
+
+    class RenderServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        """
+        Renders presentations posted over HTTP on localhost, see --serve.
+
+        Each request is handled by a thread, that hands the presentation
+        to the pool of worker processes, with the themes loaded. jobs
+        presentations are rendered at a time, up to queue_size more wait
+        for a worker, in order, and further requests are turned away
+        until one is done. A request that is not done in render_timeout
+        seconds, from when it was accepted, is stopped.
+
+        themes maps the name of each theme, that requests choose it by, to
+        its directory.
+        """
+
+        daemon_threads = True
+        allow_reuse_address = True
+
+        def __init__(self, port, themes, jobs, queue_size, render_timeout):
+            BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port),
+                                               RenderHandler)
+            self.themes = themes
+            # The pool of workers, see serve_init()
+            self.pool = None
+            self.jobs = jobs
+            self.queue_size = queue_size
+            self.render_timeout = render_timeout
+            self.stats = ServeStats()
+            self.lock = threading.Lock()
+            # Requests accepted and not yet rendered
+            self.pending = 0
+
+        def admit(self):
+            """Take a place for a request, return False if there is none."""
+            with self.lock:
+                if self.pending >= self.jobs + self.queue_size:
+                    return False
+                self.pending += 1
+                return True
+
+        def release(self):
+            with self.lock:
+                self.pending -= 1
+
+        def render(self, theme_dir, infname, outfname, accepted):
+            """Render a presentation on a worker, see serve_render()."""
+            import multiprocessing
+
+            deadline = accepted + self.render_timeout
+            result = self.pool.apply_async(serve_render, (theme_dir, infname,
+                                                          outfname, deadline))
+            try:
+                return result.get(max(deadline - time.time(), 0) + SERVE_GRACE)
+            except multiprocessing.TimeoutError:
+                return "timeout", "timed out rendering", None, None
+            except Exception as e:
+                # A bug should fail the request, not the server
+                return "error", "internal error: %s: %s" % (type(e).__name__, e), None, None
+
+        def metrics(self):
+            metrics = self.stats.as_dict()
+            with self.lock:
+                metrics["workers"] = self.jobs
+                metrics["queue_size"] = self.queue_size
+                metrics["pending"] = self.pending
+            return metrics
+
+    class RenderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """
+        The requests of a RenderServer.
+
+        POST /render?theme=NAME renders the presentation in the body, and
+        replies with the PDF. The body is the YAML input file, or a tar
+        archive of it and the files it refers to, with Content-Type
+        application/x-tar, optionally compressed. The input file in the
+        archive is named with deck=PATH, or is the only YAML file at its
+        top. GET /metrics replies with the ServeStats of the server, as
+        JSON.
+        """
+
+        server_version = "peacock"
+        timeout = SERVE_IO_TIMEOUT
+
+        def do_GET(self):
+            if urlparse.urlparse(self.path).path != "/metrics":
+                self.__reply(404, "not found\n")
+                return
+            self.__reply(200, json.dumps(self.server.metrics(), indent=2) + "\n",
+                         "application/json")
+
+        def do_POST(self):
+            accepted = time.time()
+            url = urlparse.urlparse(self.path)
+            if url.path != "/render":
+                self.__reply(404, "not found\n")
+                return
+            params = dict((name, values[-1]) for name, values
+                          in urlparse.parse_qs(url.query).iteritems())
+            self.server.stats.count("requests")
+
+            # Web pages can post to localhost too, without asking first,
+            # with the content types of forms, and they send an Origin.
+            if self.headers.get("Origin") is not None:
+                self.__fail(403, "requests from web pages are not allowed")
+                return
+            ctype = self.headers.get("Content-Type", "").split(";")[0].strip()
+            if ctype not in SERVE_YAML_TYPES + SERVE_ARCHIVE_TYPES:
+                self.__fail(415, "Content-Type must be one of: %s"
+                            % ", ".join(SERVE_YAML_TYPES + SERVE_ARCHIVE_TYPES))
+                return
+
+            themes = self.server.themes
+            theme = params.get("theme")
+            if theme is None and len(themes) == 1:
+                theme = themes.keys()[0]
+            if theme not in themes:
+                self.__fail(404, "%s, one of: %s" % (
+                    "theme not given" if theme is None else "unknown theme '%s'" % theme,
+                    ", ".join(sorted(themes))))
+                return
+
+            length = self.headers.get("Content-Length")
+            if length is None:
+                self.__fail(411, "Content-Length required")
+                return
+            try:
+                length = int(length)
+            except ValueError:
+                length = -1
+            if length < 0:
+                self.__fail(400, "invalid Content-Length")
+                return
+            if length > SERVE_MAX_BODY:
+                self.__fail(413, "presentation larger than %d bytes" % SERVE_MAX_BODY)
+                return
+
+            # The body is read only once admitted, so that clients that
+            # are turned away do not hold memory
+            if not self.server.admit():
+                self.__fail(503, "too many requests, try again later",
+                            "rejected", [ ("Retry-After", "1") ])
+                return
+
+            tmpdir = tempfile.mkdtemp(prefix="peacock-serve-")
+            try:
+                deck_dir = os.path.join(tmpdir, "deck")
+                outfname = os.path.join(tmpdir, "output.pdf")
+                try:
+                    data = self.rfile.read(length)
+                    os.mkdir(deck_dir)
+                    infname = unpack_deck(data, ctype in SERVE_ARCHIVE_TYPES,
+                                          deck_dir, params.get("deck"))
+                    status, msg, started, render = self.server.render(
+                        themes[theme], infname, outfname, accepted)
+                except FormatError as e:
+                    status, msg = "invalid", str(e)
+                finally:
+                    self.server.release()
+
+                if status != "ok":
+                    # Paths in the messages are relative to the presentation
+                    msg = msg.replace(deck_dir + os.sep, "")
+                    if status == "timeout":
+                        self.__fail(504, msg, "timed out")
+                    elif status == "invalid":
+                        self.__fail(400, msg)
+                    else:
+                        self.__fail(500, msg)
+                    return
+
+                # Counted before the reply is sent, so that a client that
+                # asks for the metrics after it sees its render in them.
+                wait = started - accepted
+                self.server.stats.add_render(time.time() - accepted, wait, render)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/pdf")
+                self.send_header("Content-Length", str(os.path.getsize(outfname)))
+                self.send_header("X-Peacock-Wait", "%.3f" % wait)
+                self.send_header("X-Peacock-Render", "%.3f" % render)
+                self.end_headers()
+                try:
+                    with open(outfname, "rb") as fp:
+                        shutil.copyfileobj(fp, self.wfile)
+                except EnvironmentError as e:
+                    self.log_error("error sending the PDF: %s", e)
+            finally:
+                shutil.rmtree(tmpdir, True)
+
+        def __fail(self, code, msg, counter="failed", headers=()):
+            self.server.stats.count(counter)
+            self.__reply(code, msg + "\n", headers=headers)
+
+        def __reply(self, code, text, ctype="text/plain", headers=()):
+            if isinstance(text, unicode):
+                text = text.encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(text)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(text)
+
+    return RenderServer
+
+def unpack_deck(data, archive, dest, deck=None):
+    """Write a posted presentation to dest, and return its input file.
+
+    data is the YAML input file, or with archive set a tar archive of
+    it and the files it refers to. The input file in the archive is
+    deck, or the only YAML file at the top of the archive. Members
+    that are not files or directories, or are outside dest, are not
+    accepted.
+    """
+    if not archive:
+        infname = os.path.join(dest, "deck.yaml")
+        with open(infname, "wb") as fp:
+            fp.write(data)
+        return infname
+
+    import io
+    import tarfile
+
+    try:
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as tar:
+            members = tar.getmembers()
+            for member in members:
+                path = os.path.normpath(member.name)
+                if (os.path.isabs(path) or path.split(os.sep)[0] == os.pardir
+                    or not (member.isfile() or member.isdir())):
+                    raise FormatError("unsafe member '%s' in archive" % member.name)
+            tar.extractall(dest, members)
+    except tarfile.TarError as e:
+        raise FormatError("error reading archive: %s" % e)
+
+    if deck is None:
+        decks = [ member.name for member in members if member.isfile()
+                  and os.sep not in os.path.normpath(member.name)
+                  and os.path.splitext(member.name)[1] in (".yaml", ".yml") ]
+        if len(decks) != 1:
+            raise FormatError("expected one YAML file at the top of the archive,"
+                              " or its name in 'deck'")
+        deck = decks[0]
+
+    infname = os.path.normpath(os.path.join(dest, deck))
+    if not infname.startswith(dest + os.sep) or not os.path.isfile(infname):
+        raise FormatError("'%s' not found in archive" % deck)
+    return infname
+
+# The Peacock instances of a serve worker process, by theme directory
+serve_peacocks = {}
+
+class RenderTimeout(Exception):
+    pass
+
+def serve_timeout(signum, frame):
+    raise RenderTimeout()
+
+def serve_stop(signum, frame):
+    raise KeyboardInterrupt()
+
+def serve_init(cache_dir, incremental, stream, fit, image_dpi, compress_level,
+               theme_dirs):
+    # The server stops the workers when it is interrupted
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGALRM, serve_timeout)
+
+    cache = DiskCache(cache_dir) if cache_dir else None
+    for theme_dir in theme_dirs:
+        peacock = Peacock(cache)
+        peacock.incremental = incremental
+        peacock.stream = stream
+        peacock.fit = fit
+        peacock.image_dpi = image_dpi
+        peacock.compress_level = compress_level
+        peacock.theme_dir = theme_dir
+        peacock.init_theme()
+        serve_peacocks[theme_dir] = peacock
+
+    # Load ahead what is otherwise loaded by the first request
+    get_markdown()
+    import pygments.lexers
+
+def serve_render(theme_dir, infname, outfname, deadline):
+    """Build a presentation in a serve worker, stopping it at deadline.
+
+    Returns (status, message, started, seconds), where status is "ok",
+    "invalid" for errors in the presentation, "error" or "timeout".
+    """
+    start = time.time()
+    if start >= deadline:
+        return "timeout", "timed out waiting for a worker", start, 0.0
+
+    peacock = serve_peacocks[theme_dir]
+    if peacock.cache:
+        # Each request is unpacked into a directory of its own
+        peacock.cache.transient_dir = os.path.dirname(os.path.abspath(outfname))
+    try:
+        signal.setitimer(signal.ITIMER_REAL, deadline - start)
+        try:
+            peacock.build_deck(infname, outfname)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            if peacock.cache:
+                peacock.cache.transient_dir = None
+            peacock.pdf = None
+            peacock.documents = None
+    except RenderTimeout:
+        return "timeout", "timed out rendering", start, time.time() - start
+    except (FormatError, EnvironmentError) as e:
+        return "invalid", str(e), start, time.time() - start
+    except (KeyError, ValueError) as e:
+        # From the presentation, like a missing meta field
+        return ("invalid", "%s: %s" % (type(e).__name__, e), start,
+                time.time() - start)
+    except (ThemeError, RuntimeError) as e:
+        return "error", str(e), start, time.time() - start
+    return "ok", None, start, time.time() - start
 
 def usage(msg=None):
-    sys.stderr.write(msg)
-    print "Usage: peacock <input-file> <output-file> <theme-dir>"
+    if msg != None: sys.stderr.write(msg)
+    print "Usage: peacock [options] <input-file> <output-file> <theme-dir>"
+    print "       peacock --batch [options] <theme-dir> <input-file>..."
+    print "       peacock --serve [options] <theme-dir>..."
+    print
+    print "Options:"
+    print "  --cache-dir=DIR   directory for cached themes (default: %s)" % default_cache_dir()
+    print "  --no-cache        do not read or write the cache"
+    print "  -i, --incremental re-use slides cached by a previous run"
+    print "  -s, --stream      write pages to the output as they are done"
+    print "  --fit             shrink the text of slides that do not fit"
+    print "  --image-dpi=N     scale down images to N dots per inch"
+    print "  --compress=LEVEL  zlib level of pages, 1-9, 0 or none for none (default: %d)" % COMPRESS_LEVEL
+    print "  --stats           print where the time of the build went"
+    print "  --stats-json=FILE write the --stats timings as JSON, - for stdout"
+    print "  -w, --watch       re-build whenever an input file changes"
+    print "  -b, --batch       build many presentations, inputs may be globs"
+    print "  -j, --jobs=N      number of worker processes"
+    print "  --manifest=FILE   file listing '<input> [<output>]' for --batch"
+    print "  --output-dir=DIR  directory for outputs of --batch"
+    print "  --serve           render presentations posted over HTTP on localhost"
+    print "  --port=N          port for --serve (default: %d)" % SERVE_PORT
+    print "  --queue=N         requests --serve queues for a worker (default: %d)" % SERVE_QUEUE
+    print "  --timeout=SECS    time limit of a --serve request (default: %d)" % SERVE_TIMEOUT
+    print "  -h, --help        show this help"
     if msg != None: exit(1)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hiswbj:",
+                                   [ "help", "cache-dir=", "no-cache",
+                                     "incremental", "stream", "fit",
+                                     "image-dpi=", "compress=", "watch",
+                                     "batch", "jobs=", "manifest=",
+                                     "output-dir=", "stats", "stats-json=",
+                                     "serve", "port=", "queue=", "timeout=" ])
+    except getopt.GetoptError as e:
+        usage("error: %s\n" % e)
+
+    cache_dir = default_cache_dir()
+    incremental = False
+    stream = False
+    fit = False
+    image_dpi = None
+    compress_level = COMPRESS_LEVEL
+    watch = False
+    batch = False
+    jobs = None
+    manifest = None
+    output_dir = None
+    stats = False
+    stats_json = None
+    serve = False
+    port = SERVE_PORT
+    queue_size = SERVE_QUEUE
+    timeout = SERVE_TIMEOUT
+    for opt, val in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            exit(0)
+        elif opt == "--cache-dir":
+            cache_dir = val
+        elif opt == "--no-cache":
+            cache_dir = None
+        elif opt in ("-i", "--incremental"):
+            incremental = True
+        elif opt in ("-s", "--stream"):
+            stream = True
+        elif opt == "--fit":
+            fit = True
+        elif opt == "--image-dpi":
+            try:
+                image_dpi = int(val)
+            except ValueError:
+                usage("error: invalid image resolution '%s'\n" % val)
+            if Image is None:
+                usage("error: --image-dpi needs the Python Imaging Library\n")
+        elif opt == "--compress":
+            if val == "none":
+                compress_level = 0
+            elif val.isdigit() and int(val) <= 9:
+                compress_level = int(val)
+            else:
+                usage("error: invalid compression level '%s'\n" % val)
+        elif opt in ("-w", "--watch"):
+            watch = True
+        elif opt in ("-b", "--batch"):
+            batch = True
+        elif opt in ("-j", "--jobs"):
+            try:
+                jobs = int(val)
+            except ValueError:
+                usage("error: invalid number of jobs '%s'\n" % val)
+        elif opt == "--manifest":
+            manifest = val
+        elif opt == "--output-dir":
+            output_dir = val
+        elif opt == "--stats":
+            stats = True
+        elif opt == "--stats-json":
+            stats_json = val
+        elif opt == "--serve":
+            serve = True
+        elif opt == "--port":
+            try:
+                port = int(val)
+            except ValueError:
+                usage("error: invalid port '%s'\n" % val)
+        elif opt == "--queue":
+            try:
+                queue_size = int(val)
+            except ValueError:
+                usage("error: invalid queue size '%s'\n" % val)
+        elif opt == "--timeout":
+            try:
+                timeout = float(val)
+            except ValueError:
+                usage("error: invalid timeout '%s'\n" % val)
+
+    if batch:
+        if len(args) < 1 or (len(args) < 2 and not manifest):
+            usage("error: insufficient arguments\n")
+    elif serve:
+        if len(args) < 1:
+            usage("error: insufficient arguments\n")
+    elif len(args) != 3:
         usage("error: insufficient arguments\n")
+    if (batch or serve) and (stats or stats_json is not None):
+        usage("error: --stats and --stats-json are not supported with %s\n"
+              % ("--batch" if batch else "--serve"))
+
+    cache = DiskCache(cache_dir) if cache_dir else None
 
     try:
-        peacock = Peacock()
-        peacock.main(sys.argv[1], sys.argv[2], sys.argv[3])
+        peacock = Peacock(cache)
+        peacock.incremental = incremental
+        peacock.stream = stream
+        peacock.fit = fit
+        peacock.image_dpi = image_dpi
+        peacock.compress_level = compress_level
+        peacock.stats_detail = stats or stats_json is not None
+        peacock.stats_json = stats_json
+        if not batch:
+            peacock.jobs = jobs or 1
+        if batch:
+            decks = batch_decks(args[1:], manifest, output_dir)
+            if peacock.batch(args[0], decks, jobs or 1):
+                exit(1)
+        elif serve:
+            peacock.serve(args, port, jobs, queue_size, timeout)
+        elif watch:
+            peacock.watch(args[0], args[1], args[2])
+        else:
+            peacock.main(args[0], args[1], args[2])
+    except KeyboardInterrupt:
+        pass
     except FormatError as e:
         error(str(e))
     except ThemeError as e:
         error(str(e))
+    except EnvironmentError as e:
+        error(str(e))
 
@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks peacock on generated presentations.
+
+Decks of each kind of element are generated, with the given number of
+slides, and built with each theme. The wall time, peak memory, output
+size and the time of each phase of the build are written to a JSON
+results file, and can be compared with the results of an earlier run.
+The start up time, of 'peacock --help', is measured as well. With
+--serve, the decks are rendered by a 'peacock --serve' server instead,
+and its metrics are saved with the results.
+"""
+
+import getopt
+import json
+import os
+import os.path
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+from collections import OrderedDict
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_DIR = os.path.dirname(TEST_DIR)
+THEMES_DIR = os.path.join(TOP_DIR, "themes")
+
+# Format of the results file
+RESULTS_VERSION = 1
+
+IMAGES = [ "control.png", "mainframe.png", "ramdisk.png" ]
+
+CODE = [
+    ("python", "def fib(n):\n    if n < 2:\n        return n\n"
+               "    return fib(n - 1) + fib(n - 2)\n"),
+    ("c", "int fib(int n)\n{\n\tif (n < 2)\n\t\treturn n;\n"
+          "\treturn fib(n - 1) + fib(n - 2);\n}\n"),
+    ("javascript", "function fib(n) {\n  if (n < 2) { return n; }\n"
+                   "  return fib(n - 1) + fib(n - 2);\n}\n"),
+    ("bash", "for f in *.yaml; do\n    peacock \"$f\" \"${f%.yaml}.pdf\" ribbon\n"
+             "done\n"),
+    ("yaml", "title: Peacock\nkeywords: [ pdf, yaml ]\n"),
+]
+
+def indent(text, spaces):
+    return "".join(" " * spaces + line if line.strip() else line
+                   for line in text.splitlines(True))
+
+def text_block(text):
+    return "  - type: text\n    text: |\n%s\n" % indent(text, 6)
+
+def gen_bullets(i):
+    return text_block("* Point %d\n    * Sub point\n        * Detail\n"
+                      "        * More detail\n    * Another sub point\n"
+                      "* Another point\n" % i)
+
+def gen_text(i):
+    return text_block("* Text with *emphasis*, **strong emphasis** and"
+                      " `code`, long enough to be wrapped over more than"
+                      " one line of the slide, number %d\n"
+                      "* Entities &amp; escapes \\*like this\\*\n" % i)
+
+def gen_code(i):
+    lang, code = CODE[i % len(CODE)]
+    return "  - type: code\n    lang: %s\n    code: |\n%s\n" % (lang, indent(code, 6))
+
+def gen_image(i):
+    src = os.path.join(TEST_DIR, IMAGES[i % len(IMAGES)])
+    return "  - type: image\n    src: %s\n    width: 300\n\n" % src
+
+def gen_twocol(i):
+    return ("  - type: layout\n    mode: two-col\n\n" + gen_text(i) +
+            "  - type: image\n    src: %s\n    width: 200\n\n"
+            % os.path.join(TEST_DIR, IMAGES[i % len(IMAGES)]))
+
+def gen_table(i):
+    rows = "".join("      - [ %d, item-%d, \"A description of item %d, long"
+                   " enough to wrap\", %d.5 ]\n" % (j, j, j, i * j)
+                   for j in range(6))
+    return ("  - type: table\n    align: [ R, L, L, R ]\n    rows:\n"
+            "      - [ \"No\", Name, Description, Value ]\n" + rows + "\n")
+
+GENERATORS = [
+    ("bullets", gen_bullets),
+    ("text", gen_text),
+    ("code", gen_code),
+    ("image", gen_image),
+    ("twocol", gen_twocol),
+    ("table", gen_table),
+]
+
+def gen_deck(fname, kind, slides):
+    """Write a deck of slides of kind, 'mixed' cycles through all kinds."""
+    gens = dict(GENERATORS)
+    with open(fname, "w") as fp:
+        fp.write("title: Benchmark %s\nauthor: Peacock\n"
+                 "email: peacock@example.com\nkeywords: [ bench ]\n---\n" % kind)
+        for i in range(slides):
+            if kind == "mixed":
+                gen = GENERATORS[i % len(GENERATORS)][1]
+            else:
+                gen = gens[kind]
+            fp.write("Slide %d:\n" % i)
+            fp.write(gen(i))
+
+def run_one(infname, outfname, theme_dir, cache_dir, options):
+    """Build a deck in this process, and print its measurements."""
+    sys.path.insert(0, TOP_DIR)
+    start = time.time()
+    import peacock
+    import_time = time.time() - start
+
+    p = peacock.Peacock(peacock.DiskCache(cache_dir))
+    p.stream = options["stream"]
+    p.fit = options["fit"]
+    p.jobs = options["jobs"]
+    if options["compress"] is not None:
+        p.compress_level = options["compress"]
+    p.main(infname, outfname, theme_dir)
+
+    maxrss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    json.dump({ "import": import_time, "phases": p.stats.phases,
+                "maxrss_kb": maxrss }, sys.stdout)
+
+class BuildError(Exception):
+    pass
+
+def measure(infname, outfname, theme_dir, cache_dir, options):
+    cmd = [ sys.executable, os.path.abspath(__file__), "--run-one",
+            json.dumps([ infname, outfname, theme_dir, cache_dir, options ]) ]
+    start = time.time()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    wall = time.time() - start
+    if proc.returncode != 0:
+        lines = err.strip().splitlines() or [ "exit status %d" % proc.returncode ]
+        raise BuildError(lines[-1])
+
+    result = json.loads(out, object_pairs_hook=OrderedDict)
+    result["wall"] = wall
+    result["size"] = os.stat(outfname).st_size
+    return result
+
+class Server(object):
+    """A 'peacock --serve' process on localhost, that renders decks."""
+
+    def __init__(self, themes, cache_dir, options):
+        cmd = [ sys.executable, os.path.join(TOP_DIR, "peacock.py"),
+                "--serve", "--port=0", "--cache-dir=%s" % cache_dir,
+                "--jobs=%d" % options["jobs"] ]
+        if options["stream"]:
+            cmd.append("--stream")
+        if options["fit"]:
+            cmd.append("--fit")
+        if options["compress"] is not None:
+            cmd.append("--compress=%d" % options["compress"])
+        cmd.extend(os.path.join(THEMES_DIR, theme) for theme in themes)
+
+        with open(os.devnull, "w") as null:
+            self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                         stderr=null)
+        # The server prints its URL when it is ready
+        match = re.search(r"http://\S+", self.proc.stdout.readline())
+        if not match:
+            self.close()
+            raise BuildError("server did not start")
+        self.url = match.group(0)
+
+    def measure(self, infname, outfname, theme):
+        with open(infname, "rb") as fp:
+            request = urllib2.Request(self.url + "render?theme=" + theme,
+                                      fp.read(),
+                                      { "Content-Type": "application/x-yaml" })
+        start = time.time()
+        try:
+            reply = urllib2.urlopen(request)
+            pdf = reply.read()
+        except urllib2.HTTPError as e:
+            lines = e.read().strip().splitlines() or [ str(e) ]
+            raise BuildError(lines[-1])
+        except urllib2.URLError as e:
+            raise BuildError(str(e.reason))
+        wall = time.time() - start
+
+        with open(outfname, "wb") as fp:
+            fp.write(pdf)
+        phases = OrderedDict([ ("wait", float(reply.info()["X-Peacock-Wait"])),
+                               ("render", float(reply.info()["X-Peacock-Render"])) ])
+        return OrderedDict([ ("phases", phases), ("wall", wall),
+                             ("size", len(pdf)) ])
+
+    def metrics(self):
+        return json.load(urllib2.urlopen(self.url + "metrics"),
+                         object_pairs_hook=OrderedDict)
+
+    def close(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+def measure_startup(repeat):
+    """Return the lowest wall time of running 'peacock --help'."""
+    cmd = [ sys.executable, os.path.join(TOP_DIR, "peacock.py"), "--help" ]
+    walls = []
+    for i in range(repeat):
+        start = time.time()
+        with open(os.devnull, "w") as null:
+            subprocess.call(cmd, stdout=null, stderr=null)
+        walls.append(time.time() - start)
+    return min(walls)
+
+def bench(kinds, themes, slides, repeat, warm, options, work_dir, server=None):
+    results = []
+    for kind in kinds:
+        infname = os.path.join(work_dir, "%s.yaml" % kind)
+        gen_deck(infname, kind, slides)
+        for theme in themes:
+            theme_dir = os.path.join(THEMES_DIR, theme)
+            outfname = os.path.join(work_dir, "%s-%s.pdf" % (kind, theme))
+            cache_dir = os.path.join(work_dir, "cache-%s-%s" % (kind, theme))
+
+            # The run with the lowest wall time is kept. Cold runs
+            # start with an empty cache, warm runs re-use it.
+            runs = []
+            try:
+                for i in range(repeat + (1 if warm else 0)):
+                    if server:
+                        runs.append(server.measure(infname, outfname, theme))
+                        continue
+                    if not warm:
+                        shutil.rmtree(cache_dir, True)
+                    runs.append(measure(infname, outfname, theme_dir,
+                                        cache_dir, options))
+                if warm:
+                    runs = runs[1:]
+                best = min(runs, key=lambda run: run["wall"])
+            except BuildError as e:
+                best = { "error": str(e) }
+
+            best.update(deck=kind, theme=theme, slides=slides)
+            results.append(best)
+            report(best)
+    return results
+
+def report(result):
+    if "error" in result:
+        print "%-8s %-13s FAILED: %s" % (result["deck"], result["theme"],
+                                         result["error"])
+        sys.stdout.flush()
+        return
+
+    # Builds by a server measure neither memory nor imports
+    phases = " ".join("%s %.2f" % (phase, secs)
+                      for phase, secs in result["phases"].iteritems())
+    if "import" in result:
+        phases = "import %.2f %s" % (result["import"], phases)
+    memory = "%6d KB" % result["maxrss_kb"] if "maxrss_kb" in result else "%9s" % "-"
+    print "%-8s %-13s %6.2fs %s %8d B  (%s)" % (
+        result["deck"], result["theme"], result["wall"], memory,
+        result["size"], phases)
+    sys.stdout.flush()
+
+def report_serve(metrics):
+    latency = metrics["seconds"]["latency"]
+    print "server: %d rendered, %.1f per second, latency p50 %.2fs p90 %.2fs max %.2fs" % (
+        metrics["counters"]["rendered"], metrics["throughput"]["overall"],
+        latency["p50"], latency["p90"], latency["max"])
+
+def compare(startup, results, baseline, threshold):
+    """Print the change from baseline, return the number of regressions."""
+    base = dict(((r["deck"], r["theme"]), r) for r in baseline["results"])
+    regressions = 0
+
+    print
+    if "startup" in baseline:
+        change = (startup - baseline["startup"]) * 100.0 / max(baseline["startup"], 1e-9)
+        regressed = change > threshold
+        print "%-22s %+8.1f%%%s" % ("startup", change,
+                                   "  REGRESSION" if regressed else "")
+        regressions += regressed
+    print "%-8s %-13s %9s %9s %9s" % ("deck", "theme", "wall", "memory", "size")
+    for result in results:
+        old = base.get((result["deck"], result["theme"]))
+        if "error" in result:
+            print "%-8s %-13s FAILED%s" % (result["deck"], result["theme"],
+                                           "" if old and "error" in old
+                                           else "  REGRESSION")
+            regressions += not (old and "error" in old)
+            continue
+        if old is None or "error" in old or old["slides"] != result["slides"]:
+            print "%-8s %-13s no baseline" % (result["deck"], result["theme"])
+            continue
+
+        changes = []
+        regressed = False
+        for field in ("wall", "maxrss_kb", "size"):
+            if field not in result or field not in old:
+                changes.append("%9s" % "-")
+                continue
+            change = (result[field] - old[field]) * 100.0 / max(old[field], 1e-9)
+            changes.append("%+8.1f%%" % change)
+            if change > threshold:
+                regressed = True
+        mark = "  REGRESSION" if regressed else ""
+        print "%-8s %-13s %s%s" % (result["deck"], result["theme"],
+                                   " ".join(changes), mark)
+        regressions += regressed
+
+    return regressions
+
+def usage(msg=None):
+    if msg != None: sys.stderr.write(msg)
+    print "Usage: bench.py [options]"
+    print
+    print "Options:"
+    print "  --slides=N        slides in each deck (default: 50)"
+    print "  --decks=LIST      comma separated decks to build, of"
+    print "                    %s, mixed (default: all)" % ", ".join(k for k, g in GENERATORS)
+    print "  --themes=LIST     comma separated themes (default: ribbon,contemporain)"
+    print "  --repeat=N        builds of each deck, the fastest is kept (default: 3)"
+    print "  --warm            re-use the cache between builds"
+    print "  -s, --stream      build with --stream"
+    print "  --fit             build with --fit"
+    print "  -j, --jobs=N      build with N worker processes"
+    print "  --compress=LEVEL  build with --compress=LEVEL"
+    print "  --serve           render the decks with a 'peacock --serve' server"
+    print "  -o, --output=FILE write results to FILE (default: bench-results.json)"
+    print "  --baseline=FILE   compare with results saved in FILE"
+    print "  --threshold=PCT   change counted as a regression (default: 10)"
+    print "  --keep            keep the generated decks and outputs"
+    print "  -h, --help        show this help"
+    exit(1)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "sj:o:h",
+                                   [ "slides=", "decks=", "themes=", "repeat=",
+                                     "warm", "stream", "fit", "jobs=",
+                                     "compress=",
+                                     "output=", "baseline=", "threshold=",
+                                     "keep", "serve", "help", "run-one=" ])
+    except getopt.GetoptError as e:
+        usage("error: %s\n" % e)
+
+    slides = 50
+    kinds = [ kind for kind, gen in GENERATORS ] + [ "mixed" ]
+    themes = [ "ribbon", "contemporain" ]
+    repeat = 3
+    warm = False
+    options = { "stream": False, "fit": False, "jobs": 1, "compress": None }
+    output = "bench-results.json"
+    baseline = None
+    threshold = 10.0
+    keep = False
+    serve = False
+
+    try:
+        for opt, val in opts:
+            if opt == "--run-one":
+                run_one(*json.loads(val))
+                return 0
+            elif opt == "--slides":
+                slides = int(val)
+            elif opt == "--decks":
+                kinds = val.split(",")
+                for kind in kinds:
+                    if kind != "mixed" and kind not in dict(GENERATORS):
+                        usage("error: unknown deck '%s'\n" % kind)
+            elif opt == "--themes":
+                themes = val.split(",")
+            elif opt == "--repeat":
+                repeat = int(val)
+            elif opt == "--warm":
+                warm = True
+            elif opt in ("-s", "--stream"):
+                options["stream"] = True
+            elif opt == "--fit":
+                options["fit"] = True
+            elif opt in ("-j", "--jobs"):
+                options["jobs"] = int(val)
+            elif opt == "--compress":
+                options["compress"] = 0 if val == "none" else int(val)
+            elif opt in ("-o", "--output"):
+                output = val
+            elif opt == "--baseline":
+                baseline = val
+            elif opt == "--threshold":
+                threshold = float(val)
+            elif opt == "--keep":
+                keep = True
+            elif opt == "--serve":
+                serve = True
+            elif opt in ("-h", "--help"):
+                usage()
+    except ValueError as e:
+        usage("error: %s\n" % e)
+
+    if len(args) != 0:
+        usage("error: unexpected arguments\n")
+
+    base = None
+    if baseline:
+        with open(baseline) as fp:
+            base = json.load(fp)
+        if base.get("version") != RESULTS_VERSION:
+            usage("error: baseline '%s' has an unknown format\n" % baseline)
+
+    startup = measure_startup(max(repeat, 1))
+    print "startup %.2fs" % startup
+    sys.stdout.flush()
+
+    work_dir = tempfile.mkdtemp(prefix="peacock-bench-")
+    server = None
+    metrics = None
+    try:
+        if serve:
+            server = Server(themes, os.path.join(work_dir, "cache"), options)
+        results = bench(kinds, themes, slides, repeat, warm, options, work_dir,
+                        server)
+        if server:
+            metrics = server.metrics()
+            report_serve(metrics)
+    except BuildError as e:
+        sys.stderr.write("error: %s\n" % e)
+        return 1
+    finally:
+        if server:
+            server.close()
+        if keep:
+            print "decks and outputs kept in %s" % work_dir
+        else:
+            shutil.rmtree(work_dir, True)
+
+    with open(output, "w") as fp:
+        json.dump({ "version": RESULTS_VERSION,
+                    "python": platform.python_version(),
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "options": dict(options, slides=slides, repeat=repeat,
+                                    warm=warm, serve=serve),
+                    "startup": startup,
+                    "results": results,
+                    "serve": metrics }, fp, indent=2)
+    print "results written to %s" % output
+
+    if base and compare(startup, results, base, threshold):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
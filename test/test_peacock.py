@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""
+Tests of peacock, that build generated presentations with the
+bundled ribbon theme, and check the output and the messages.
+
+    python test/test_peacock.py
+"""
+
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_DIR = os.path.dirname(TEST_DIR)
+PEACOCK = os.path.join(TOP_DIR, "peacock.py")
+THEME_DIR = os.path.join(TOP_DIR, "themes", "ribbon")
+
+META = ("title: Test\nauthor: Peacock\nemail: peacock@example.com\n"
+        "keywords: [ test ]\n---\n")
+
+def tall_table(rows):
+    cell = "\\n".join(str(i) for i in range(rows))
+    return ("  - type: table\n    rows:\n      - [ Key, Value ]\n"
+            "      - [ a, \"%s\" ]\n      - [ b, after ]\n" % cell)
+
+class PeacockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="peacock-test-")
+        self.infname = os.path.join(self.dir, "deck.yaml")
+        self.outfname = os.path.join(self.dir, "deck.pdf")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, True)
+
+    def write_deck(self, slides, meta=META):
+        with open(self.infname, "w") as fp:
+            fp.write(meta + slides)
+
+    def build(self, *options):
+        """Build the deck, return the exit status and the warnings."""
+        cmd = [ sys.executable, PEACOCK, "--no-cache" ] + list(options)
+        cmd += [ self.infname, self.outfname, THEME_DIR ]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        warnings = [ line for line in err.splitlines()
+                     if line.startswith("peacock:") ]
+        return proc.returncode, warnings
+
+class OverflowTest(PeacockTest):
+
+    def image_slide(self):
+        return ("Tall Image:\n  - type: image\n    src: %s\n    width: 300\n"
+                % os.path.join(TEST_DIR, "ramdisk.png"))
+
+    def test_image_too_tall(self):
+        self.write_deck(self.image_slide())
+        status, warnings = self.build()
+        self.assertEqual(status, 0)
+        self.assertEqual(warnings, [ "peacock: warning: %s: slide 'Tall Image'"
+                                     " does not fit, it runs off the bottom"
+                                     " of the page" % self.infname ])
+
+    def test_image_too_tall_fit(self):
+        # Shrinking the text does not help, the slide is left as it is
+        self.write_deck(self.image_slide())
+        status, warnings = self.build("--fit")
+        self.assertEqual(status, 0)
+        self.assertEqual(len(warnings), 1)
+        self.assertIn("runs off the bottom of the page", warnings[0])
+
+    def test_table_row_too_tall(self):
+        self.write_deck("Tall Row:\n" + tall_table(20))
+        status, warnings = self.build()
+        self.assertEqual(status, 0)
+        self.assertEqual(len(warnings), 1)
+        self.assertIn("slide 'Tall Row' does not fit, it runs off", warnings[0])
+
+    def test_table_row_too_tall_fit(self):
+        self.write_deck("Tall Row:\n" + tall_table(20))
+        status, warnings = self.build("--fit")
+        self.assertEqual(status, 0)
+        self.assertEqual(len(warnings), 1)
+        self.assertIn("text scaled to", warnings[0])
+
+        self.write_deck("Taller Row:\n" + tall_table(100))
+        status, warnings = self.build("--fit")
+        self.assertEqual(status, 0)
+        self.assertEqual(len(warnings), 1)
+        self.assertIn("slide 'Taller Row' does not fit, it runs off",
+                      warnings[0])
+
+    def test_long_table(self):
+        # The pages a table is continued on are not an overflow
+        rows = "".join("      - [ %d, row %d ]\n" % (i, i) for i in range(100))
+        self.write_deck("Long:\n  - type: table\n    rows:\n" + rows)
+        for options in ((), ("--fit",)):
+            status, warnings = self.build(*options)
+            self.assertEqual(status, 0)
+            self.assertEqual(warnings, [])
+
+class WatchTest(PeacockTest):
+
+    def setUp(self):
+        PeacockTest.setUp(self)
+        self.logfname = os.path.join(self.dir, "watch.log")
+        self.proc = None
+
+    def tearDown(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        PeacockTest.tearDown(self)
+
+    def wait_for(self, text, count):
+        """Wait for the watcher to print text count times."""
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            self.assertIsNone(self.proc.poll(), "watcher exited")
+            with open(self.logfname) as fp:
+                if fp.read().count(text) >= count:
+                    return
+            time.sleep(0.1)
+        self.fail("watcher did not print '%s'" % text)
+
+    def test_meta_error(self):
+        slides = "Slide:\n  - type: text\n    text: |\n      * One\n"
+        self.write_deck(slides)
+        with open(self.logfname, "w") as log:
+            cmd = [ sys.executable, PEACOCK, "--no-cache", "--watch",
+                    self.infname, self.outfname, THEME_DIR ]
+            self.proc = subprocess.Popen(cmd, stdout=log,
+                                         stderr=subprocess.STDOUT)
+        self.wait_for("peacock: wrote", 1)
+
+        self.write_deck(slides, META.replace("email", "mail"))
+        self.wait_for("peacock: KeyError: 'email'", 1)
+
+        self.write_deck(slides)
+        self.wait_for("peacock: wrote", 2)
+
+if __name__ == "__main__":
+    unittest.main()